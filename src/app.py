@@ -1,4 +1,5 @@
 import sys
+import threading
 import time
 import os
 from PyQt6.QtCore import QThread, Qt, pyqtSignal
@@ -12,6 +13,7 @@ from src.ui.overlay import OverlayWidget
 from src.ui.map_overlay import MapOverlayWidget
 from src.ui.hp_overlay import HpOverlayWidget
 from src.ui.settings import SettingsWindow
+from src.config import Config
 from src.updater import Updater
 from src.common import APP_FULLNAME, APP_VERSION, ICON_PATH
 from src.logger import info, warning, error
@@ -92,6 +94,10 @@ if __name__ == "__main__":
     menu.addSeparator()
     tray_icon.setContextMenu(menu)
     tray_icon.show()
+
+    # 托盘图标显示后在后台预先加载地图识别资源
+    if Config.get().map_assets_warm_up and updater.map_detect_enabled:
+        threading.Thread(target=updater.detector.warm_up, name="MapAssetsWarmUp", daemon=True).start()
     
     def show_menu_at_cursor_pos():
         cursor_pos = QCursor.pos()
@@ -50,8 +50,25 @@ class Config:
     map_overlay_draw_size_ratio: float | None
     full_map_hough_circle_thres: list[int]
     full_map_error_threshold: float
+    full_map_gate_min_contrast: float
+    full_map_gate_min_ring_coverage: float
     earth_shifting_error_threshold: float
     map_pattern_match_interval: float
+    map_poi_match_workers: int
+    map_pattern_early_stop_error_budget: int | None
+    map_register_enabled: bool
+    map_register_min_correlation: float
+    map_pattern_cache_size: int
+    map_pattern_cache_max_changed_pois: int
+    map_evidence_max_frames: int
+    map_evidence_min_confidence: float
+    map_pattern_top_k: int
+    map_pattern_alternate_min_confidence: float
+    map_pattern_rematch_confidence: float
+    map_pattern_rematch_delay: float
+    map_pattern_max_rematches: int
+    map_assets_warm_up: bool
+    map_overlay_cache_max_mb: int
 
     hpbar_region_aspect_ratio: float
     hpbar_detect_std_height: int
@@ -69,6 +86,10 @@ class Config:
 
     bug_report_email: str
 
+    debug_artifact_queue_size: int
+    debug_artifact_min_interval: float
+    debug_artifact_retention: int
+
     @staticmethod
     def get() -> 'Config':
         global _config, _config_mtime
@@ -0,0 +1,93 @@
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from src.common import get_appdata_path
+from src.config import Config
+from src.logger import debug, error, is_debug_enabled
+
+DEBUG_ARTIFACT_DIR = get_appdata_path("debug")
+
+
+class DebugArtifactWriter:
+    """
+    调试图片的后台写入服务：检测线程只负责入队，编码和磁盘IO都在后台线程完成。
+    队列满或未到该图片的最短保存间隔时直接丢弃，每种图片只在磁盘上保留最近若干份
+    """
+    def __init__(self):
+        self._queue: queue.Queue | None = None
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+        self._last_submit_time: dict[str, float] = {}
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None:
+                self._queue = queue.Queue(maxsize=Config.get().debug_artifact_queue_size)
+                self._thread = threading.Thread(target=self._run, name="DebugArtifactWriter", daemon=True)
+                self._thread.start()
+
+    def submit(self, name: str, image: np.ndarray | Image.Image, min_interval: float | None = None) -> bool:
+        """
+        提交一张调试图片，numpy数组视为RGB格式。提交后调用方不应再修改该图片。
+        返回是否成功入队
+        """
+        if not is_debug_enabled():
+            return False
+        config = Config.get()
+        if min_interval is None:
+            min_interval = config.debug_artifact_min_interval
+        now = time.time()
+        with self._lock:
+            if now - self._last_submit_time.get(name, 0.0) < min_interval:
+                return False
+            self._last_submit_time[name] = now
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((name, image, now))
+            return True
+        except queue.Full:
+            debug(f"Debug artifact queue full, drop {name}")
+            return False
+
+    def _run(self):
+        while True:
+            name, image, t = self._queue.get()
+            try:
+                self._write(name, image, t)
+            except Exception:
+                error(f"Write debug artifact {name} error")
+            finally:
+                self._queue.task_done()
+
+    def _write(self, name: str, image: np.ndarray | Image.Image, t: float):
+        os.makedirs(DEBUG_ARTIFACT_DIR, exist_ok=True)
+        stem, ext = os.path.splitext(name)
+        timestamp = datetime.fromtimestamp(t).strftime("%Y%m%d_%H%M%S_%f")
+        path = os.path.join(DEBUG_ARTIFACT_DIR, f"{stem}_{timestamp}{ext}")
+        if isinstance(image, Image.Image):
+            image.convert("RGB").save(path)
+        else:
+            cv2.imwrite(path, cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
+
+        # 滚动删除同名调试图片中最旧的部分
+        retention = Config.get().debug_artifact_retention
+        history = sorted(
+            f for f in os.listdir(DEBUG_ARTIFACT_DIR)
+            if f.startswith(f"{stem}_") and f.endswith(ext)
+            and len(f) == len(stem) + len(timestamp) + len(ext) + 1
+        )
+        for f in history[:max(0, len(history) - retention)]:
+            os.remove(os.path.join(DEBUG_ARTIFACT_DIR, f))
+
+
+_writer = DebugArtifactWriter()
+
+def save_debug_image(name: str, image: np.ndarray | Image.Image, min_interval: float | None = None) -> bool:
+    return _writer.submit(name, image, min_interval)
@@ -2,9 +2,10 @@ from mss.base import MSSBase
 
 from src.detector.rain_detector import RainDetector, RainDetectResult, RainDetectParam
 from src.detector.day_detector import DayDetector, DayDetectResult, DayDetectParam
-from src.detector.map_detector import MapDetector, MapDetectResult, MapDetectParam
+from src.detector.map_detector import MapDetector, MapDetectResult, MapDetectParam, MapEvidence, MapMatchCancelled
 from src.detector.hp_detector import HpDetector, HpDetectResult, HpDetectParam
 from src.detector.art_detector import ArtDetector, ArtDetectResult, ArtDetectParam
+import threading
 from dataclasses import dataclass
 from mss import mss
 
@@ -30,16 +31,31 @@ class DetectorManager:
     def __init__(self):
         self.rain_detector = RainDetector()
         self.day_detector = DayDetector()
-        self.map_detector = MapDetector()
         self.hp_detector = HpDetector()
         self.art_detector = ArtDetector()
+        # 地图识别器需要加载地图数据库，首次使用时构建
+        self._map_detector: MapDetector | None = None
+        self._map_detector_lock = threading.Lock()
+
+    @property
+    def map_detector(self) -> MapDetector:
+        with self._map_detector_lock:
+            if self._map_detector is None:
+                self._map_detector = MapDetector()
+            return self._map_detector
+
+    def warm_up(self):
+        self.map_detector.warm_up()
 
     def detect(self, params: DetectParam) -> DetectResult:
         result = DetectResult()
         with mss() as sct:
             result.day_detect_result = self.day_detector.detect(sct, params.day_detect_param)
             result.rain_detect_result = self.rain_detector.detect(sct, params.rain_detect_param)
-            result.map_detect_result = self.map_detector.detect(sct, params.map_detect_param)
+            if params.map_detect_param is not None:
+                result.map_detect_result = self.map_detector.detect(sct, params.map_detect_param)
+            else:
+                result.map_detect_result = MapDetectResult()
             result.hp_detect_result = self.hp_detector.detect(sct, params.hp_detect_param)
             result.art_detect_result = self.art_detector.detect(sct, params.art_detect_param)
         return result
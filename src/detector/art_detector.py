@@ -1,4 +1,3 @@
-import cv2
 import numpy as np
 from dataclasses import dataclass
 from PIL import Image
@@ -7,9 +6,10 @@ from PyQt6.QtGui import QPixmap
 from mss.base import MSSBase
 
 from src.config import Config
-from src.common import get_data_path, get_appdata_path
+from src.common import get_data_path
+from src.debug_artifact import save_debug_image
 from src.logger import info, warning, error
-from src.detector.utils import grab_region, resize_by_height_keep_aspect_ratio, match_template
+from src.detector.utils import TemplateBank, grab_region, resize_by_height_keep_aspect_ratio
 
 @dataclass
 class ArtDetectParam:
@@ -23,13 +23,14 @@ class ArtDetectResult:
 class ArtDetector:
     def __init__(self):
         config = Config.get()
-        self.art_imgs: dict[str, np.ndarray] = {}
+        # 所有绝招模板批量进行FFT互相关匹配，截图只做一次FFT，模板频谱缓存
+        self.templates = TemplateBank(strategy='fft')
         for art_type in config.art_info.keys():
             img = Image.open(get_data_path(f"icons/art/{art_type}.png")).convert("RGB")
             img = resize_by_height_keep_aspect_ratio(img, config.art_detect_standard_size)
             w, h = img.size
             img = np.array(img)[h//4:h*3//4, w//4:w*3//4]
-            self.art_imgs[art_type] = img
+            self.templates.add(art_type, img)
 
     def detect(self, sct: MSSBase, params: ArtDetectParam | None) -> ArtDetectResult:
         if params is None or params.art_region is None:
@@ -42,14 +43,15 @@ class ArtDetector:
         sc = np.array(sc)
 
         best_art_type, best_score = None, 1.0
-        for art_type, art_img in self.art_imgs.items():
-            match, score = match_template(sc, art_img, config.art_detect_match_scales)
+        matches = self.templates.match_all(sc, config.art_detect_match_scales)
+        for art_type in self.templates.templates.keys():
+            score = matches[art_type].score if art_type in matches else 1.0
             if score < best_score:
                 best_art_type, best_score = art_type, score
             info(f"Art type: {art_type}, score: {score:.4f}")
-        
+
         # 保存用于调试
-        cv2.imwrite(get_appdata_path("last_art_sc.png"), cv2.cvtColor(sc, cv2.COLOR_RGB2BGR))
+        save_debug_image("last_art_sc.png", sc)
 
         if best_score < config.art_detect_threshold:
             ret.art_type = best_art_type
@@ -58,6 +60,6 @@ class ArtDetector:
             info(f"No art detected, best score: {best_score:.4f}")
 
         return ret
-    
+
 
 
@@ -0,0 +1,109 @@
+import hashlib
+import os
+import shutil
+import threading
+from pathlib import Path
+from typing import Any, Callable
+
+import numpy as np
+
+from src.common import get_appdata_path, get_data_path
+from src.logger import info, warning
+
+# 预计算资源的格式发生变化时递增，使旧缓存失效
+ASSET_CACHE_VERSION = 2
+# 条目目录中记录所有数组名称的清单文件，最后写入
+MANIFEST_NAME = "manifest.txt"
+
+
+def hash_data_dirs(dirs: list[str]) -> str:
+    """
+    计算数据目录下所有文件（相对路径和内容）的哈希
+    """
+    h = hashlib.sha1()
+    for d in dirs:
+        root = Path(get_data_path(d))
+        for path in sorted(p for p in root.rglob("*") if p.is_file()):
+            h.update(path.relative_to(root.parent).as_posix().encode("utf-8"))
+            h.update(path.read_bytes())
+    return h.hexdigest()
+
+
+class AssetCache:
+    """
+    存放在应用数据目录中的预计算资源缓存。
+    缓存目录以版本号和源数据目录的内容哈希命名，源数据变化后自动使用新目录并删除旧目录。
+    每个条目是一组 .npy 数组和记录数组名称的清单，读取时以内存映射方式加载，无需解码或重新计算。
+    清单中的数组缺失或无法读取时视为缓存未命中
+    """
+    def __init__(self, name: str, source_dirs: list[str]):
+        self.name = name
+        self.source_dirs = source_dirs
+        self._dir: Path | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def dir(self) -> Path:
+        with self._lock:
+            if self._dir is None:
+                key = hash_data_dirs(self.source_dirs)[:16]
+                root = Path(get_appdata_path("cache"))
+                self._dir = root / f"{self.name}_v{ASSET_CACHE_VERSION}_{key}"
+                # 清理同名的旧缓存
+                for old in root.glob(f"{self.name}_v*"):
+                    if old != self._dir and old.is_dir():
+                        shutil.rmtree(old, ignore_errors=True)
+                        info(f"AssetCache: removed stale cache {old.name}")
+            return self._dir
+
+    def _entry_dir(self, entry: str, params: Any) -> Path:
+        params_key = hashlib.sha1(repr(params).encode("utf-8")).hexdigest()[:8]
+        return self.dir / f"{entry}_{params_key}"
+
+    def load(self, entry: str, params: Any = None) -> dict[str, np.ndarray] | None:
+        entry_dir = self._entry_dir(entry, params)
+        manifest = entry_dir / MANIFEST_NAME
+        if not manifest.is_file():
+            return None
+        try:
+            names = manifest.read_text(encoding="utf-8").split()
+            return {name: np.load(entry_dir / f"{name}.npy", mmap_mode="r") for name in names}
+        except Exception as e:
+            warning(f"AssetCache: failed to load {entry_dir}: {e}")
+            return None
+
+    def save(self, entry: str, arrays: dict[str, np.ndarray], params: Any = None):
+        # 先写入临时目录再重命名，防止写入过程中程序崩溃导致缓存损坏
+        entry_dir = self._entry_dir(entry, params)
+        tmp_dir = entry_dir.with_name(entry_dir.name + f".tmp{os.getpid()}_{threading.get_ident()}")
+        try:
+            tmp_dir.mkdir(parents=True, exist_ok=True)
+            for name, array in arrays.items():
+                np.save(tmp_dir / f"{name}.npy", np.ascontiguousarray(array))
+            (tmp_dir / MANIFEST_NAME).write_text("\n".join(arrays.keys()), encoding="utf-8")
+            if entry_dir.exists():
+                shutil.rmtree(entry_dir, ignore_errors=True)
+            os.replace(tmp_dir, entry_dir)
+        except Exception as e:
+            warning(f"AssetCache: failed to save {entry_dir}: {e}")
+        finally:
+            if tmp_dir.exists():
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def get_or_create(self, entry: str, builder: Callable[[], dict[str, np.ndarray]],
+                      params: Any = None) -> dict[str, np.ndarray]:
+        """
+        读取缓存条目，不存在时调用 builder 计算并写入缓存。
+        params 为影响计算结果的代码参数，参数变化时使用不同的条目
+        """
+        arrays = self.load(entry, params)
+        if arrays is None:
+            arrays = builder()
+            self.save(entry, arrays, params)
+        return arrays
+
+
+# 地图匹配相关的预计算资源
+MAP_ASSET_CACHE = AssetCache("map_assets", ["maps", "icons", "csv"])
+# 由CSV编译的地图信息，只依赖CSV目录，避免每次启动为计算缓存键读取图片
+MAP_INFO_CACHE = AssetCache("map_info", ["csv"])
@@ -9,7 +9,7 @@ import yaml
 from src.config import Config
 from src.logger import info, warning, error, debug
 from src.common import get_data_path
-from src.detector.utils import resize_by_height_keep_aspect_ratio, grab_region
+from src.detector.utils import TemplateBank, resize_by_height_keep_aspect_ratio, grab_region
 
 
 def get_image_mask(image: Image.Image) -> np.ndarray:
@@ -23,23 +23,6 @@ def get_image_mask(image: Image.Image) -> np.ndarray:
     # cv2.imwrite(f"sandbox/debug_hsv_mask.png", mask)
     return mask
 
-def match_mask(image: np.ndarray, template: np.ndarray) -> float:
-    t = time.time()
-    scale_range = np.linspace(*Config.get().scale_range, endpoint=True)
-    score = float('inf')
-    for scale in scale_range:
-        w, h = template.shape[::-1]
-        resized_template = cv2.resize(template, (int(w * scale), int(h * scale)))
-        if resized_template.shape[0] > image.shape[0] or resized_template.shape[1] > image.shape[1]:
-            continue
-        res = cv2.matchTemplate(image, resized_template, cv2.TM_SQDIFF_NORMED)
-        min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(res)
-        score = min(score, min_val)
-    # print("match mask score: ", score)
-    # print("match mask time: ", time.time() - t)
-    return score
-
-
 @dataclass
 class DayDetectParam:
     day1_region: tuple[int] | None = None
@@ -69,6 +52,8 @@ class DayDetector:
     def __init__(self):
         config = Config.get()
         self.templates: dict[str, DayTempalte] = {}
+        # 所有语言的DAYX掩码模板，按 (语言, 第几天) 索引
+        self.template_bank = TemplateBank(strategy='scan')
         for lang in config.dayx_detect_langs.keys():
             day1_image = Image.open(get_data_path(f"day_template/{lang}_1.png")).convert("RGB")
             day2_image = Image.open(get_data_path(f"day_template/{lang}_2.png")).convert("RGB")
@@ -86,6 +71,9 @@ class DayDetector:
                 day3_w_ratio=day3_mask.shape[1] / day1_mask.shape[1],
             )
             self.templates[lang] = template
+            self.template_bank.add((lang, 1), day1_mask)
+            self.template_bank.add((lang, 2), day2_mask)
+            self.template_bank.add((lang, 3), day3_mask)
 
     def match(self, sct: MSSBase, template: DayTempalte, day1_region: tuple[int]) -> tuple[bool, float]:
         try:
@@ -98,7 +86,7 @@ class DayDetector:
             day3_w = int(w * template.day3_w_ratio)
             day3_region = (cx - day3_w // 2, cy - h // 2, day3_w, h)
             sc = grab_region(sct, day3_region)
-            def match_region(region: tuple[int], template_mask: np.ndarray) -> float:
+            def match_region(region: tuple[int], day: int) -> float:
                 region = (
                     region[0] - day3_region[0], 
                     region[1] - day3_region[1], 
@@ -108,10 +96,11 @@ class DayDetector:
                 img = sc.crop(region)
                 img = resize_by_height_keep_aspect_ratio(img, config.template_standard_height)
                 img_mask = get_image_mask(img)
-                return match_mask(img_mask, template_mask)
-            score_day1 = match_region(day1_region, template.day1_mask)
-            score_day2 = match_region(day2_region, template.day2_mask)
-            score_day3 = match_region(day3_region, template.day3_mask)
+                match = self.template_bank.best_match(img_mask, config.scale_range, [(template.lang, day)])
+                return match.score if match is not None else float('inf')
+            score_day1 = match_region(day1_region, 1)
+            score_day2 = match_region(day2_region, 2)
+            score_day3 = match_region(day3_region, 3)
             debug(f"detect dayx time: {time.time() - t} lang: {template.lang} score: {score_day1:.2f}, {score_day2:.2f}, {score_day3:.2f}")
             return score_day1, score_day2, score_day3
         except Exception as e:
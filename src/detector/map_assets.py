@@ -0,0 +1,118 @@
+import time
+from typing import Any
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from src.common import get_data_path
+from src.detector.utils import LRUCache
+from src.logger import info
+
+CV2_RESIZE_METHOD = cv2.INTER_CUBIC
+PIL_RESAMPLE_METHOD = Image.Resampling.BICUBIC
+
+
+def open_pil_image(path: str, size: tuple[int, int] | None = None) -> Image.Image:
+    image = Image.open(get_data_path(path)).convert("RGBA")
+    if size is not None:
+        image = image.resize(size, resample=PIL_RESAMPLE_METHOD)
+    return image
+
+
+def open_cv2_image(path: str, size: tuple[int, int] | None = None) -> np.ndarray:
+    image = cv2.cvtColor(cv2.imread(get_data_path(path)), cv2.COLOR_BGR2RGB)
+    if size is not None:
+        image = cv2.resize(image, size, interpolation=CV2_RESIZE_METHOD)
+    return image
+
+
+# 有背景图的地形，4号地形没有对应的地图
+MAP_BG_IDS = [0, 1, 2, 3, 5]
+
+
+def map_bg_path(earth_shifting: int) -> str:
+    return f"maps/{earth_shifting}.jpg"
+
+
+def poi_icon_path(construct_class: int) -> str:
+    return f"icons/construct/{construct_class}.png"
+
+
+def attribute_icon_path(i: int) -> str:
+    return f"icons/attribute/{i}.png"
+
+
+def condition_icon_path(i: int) -> str:
+    return f"icons/condition/{i}.png"
+
+
+# 具有属性或异常状态子图标的POI类型 → 子图标路径
+POI_SUBICON_MAP = {
+    30301: attribute_icon_path(1),  # 结晶人要塞-魔
+    32101: attribute_icon_path(0),  # 红狮子营地-火
+    32102: attribute_icon_path(2),  # 骑士营地-雷
+    32200: attribute_icon_path(0),  # 战车营地-火
+    32201: condition_icon_path(3),  # 癫火营地-癫火
+    34001: condition_icon_path(0),  # 鲜血遗迹-出血
+    34002: condition_icon_path(1),  # 萨米尔遗迹-冻伤
+    34003: attribute_icon_path(3),  # 白金遗迹-圣
+    34100: condition_icon_path(5),  # 调香师遗迹-中毒
+    34101: condition_icon_path(5),  # 堕落调香师遗迹-中毒
+    34102: attribute_icon_path(1),  # 法师遗迹-魔
+    34103: condition_icon_path(1),  # 白金射手遗迹-冻伤
+    34104: condition_icon_path(6),  # 卢恩熊遗迹-睡眠
+    34200: condition_icon_path(2),  # 蚯蚓脸遗迹-咒死
+    34300: attribute_icon_path(2),  # 兽人遗迹-雷
+    38000: attribute_icon_path(3),  # 使者教堂-圣
+    38100: attribute_icon_path(0),  # 火焰教堂-火
+}
+
+# 解码后的图像缓存容量，地形背景每张约1.6MB
+MAP_ASSETS_MAX_BYTES = 32 * 1024 * 1024
+# 绘制地图信息用的缩放后图标缓存容量，全屏地图下宝藏图层每张约5MB
+MAP_OVERLAY_SPRITES_MAX_BYTES = 64 * 1024 * 1024
+
+
+def image_nbytes(image: Any) -> int:
+    if isinstance(image, np.ndarray):
+        return image.nbytes
+    if isinstance(image, Image.Image):
+        return image.width * image.height * len(image.getbands())
+    return 0
+
+
+class AssetRegistry:
+    """
+    按路径提供数据目录中的图像，首次使用时解码，解码（和缩放）结果保存在按字节数限制容量的LRU缓存中。
+    返回的图像在多处共享，调用方不能原地修改
+    """
+    def __init__(self, max_bytes: int):
+        self.cache = LRUCache(max_bytes=max_bytes, sizeof=image_nbytes)
+
+    def cv2_image(self, path: str) -> np.ndarray:
+        def load() -> np.ndarray:
+            image = open_cv2_image(path)
+            image.flags.writeable = False
+            return image
+        return self.cache.get_or_create(("cv2", path), load)
+
+    def pil_image(self, path: str, size: tuple[int, int] | None = None) -> Image.Image:
+        """
+        size 不为None时返回缩放到该尺寸的图像，每种 (路径, 尺寸) 只解码和缩放一次
+        """
+        return self.cache.get_or_create(("pil", path, size), lambda: open_pil_image(path, size))
+
+    def warm_up(self, cv2_paths: list[str], pil_paths: list[str]):
+        t = time.time()
+        for path in cv2_paths:
+            self.cv2_image(path)
+        for path in pil_paths:
+            self.pil_image(path)
+        info(f"AssetRegistry: warmed up {len(cv2_paths) + len(pil_paths)} images, time cost: {time.time() - t:.4f}s")
+
+
+# 地图识别和绘制用的地形背景与图标
+MAP_ASSETS = AssetRegistry(max_bytes=MAP_ASSETS_MAX_BYTES)
+# 绘制地图信息用的图标，按绘制尺寸缩放后缓存，多个候选地图共用
+MAP_OVERLAY_SPRITES = AssetRegistry(max_bytes=MAP_OVERLAY_SPRITES_MAX_BYTES)
@@ -1,36 +1,38 @@
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from dataclasses import dataclass
+from typing import Callable, Iterator
 
 import cv2
 import numpy as np
 from PIL import Image
 from mss.base import MSSBase
 
-from src.common import get_appdata_path, get_data_path
+from src.common import get_data_path
 from src.config import Config
-from src.detector.map_info import (Construct, MapPattern, Position, STD_MAP_SIZE, load_map_info)
-from src.detector.utils import (draw_icon, draw_text, grab_region, paste_cv2)
-from src.logger import debug, info
-
-CV2_RESIZE_METHOD = cv2.INTER_CUBIC
-PIL_RESAMPLE_METHOD = Image.Resampling.BICUBIC
-
-
-def open_pil_image(path: str, size: tuple[int, int] | None = None) -> Image.Image:
-    image = Image.open(get_data_path(path)).convert("RGBA")
-    if size is not None:
-        image = image.resize(size, resample=PIL_RESAMPLE_METHOD)
-    return image
-
-
-def open_cv2_image(path: str, size: tuple[int, int] | None = None) -> np.ndarray:
-    image = cv2.cvtColor(cv2.imread(get_data_path(path)), cv2.COLOR_BGR2RGB)
-    if size is not None:
-        image = cv2.resize(image, size, interpolation=CV2_RESIZE_METHOD)
-    return image
-
+from src.debug_artifact import save_debug_image
+from src.detector.asset_cache import MAP_ASSET_CACHE, MAP_INFO_CACHE
+from src.detector.map_assets import (CV2_RESIZE_METHOD, MAP_ASSETS, MAP_BG_IDS, MAP_OVERLAY_SPRITES, PIL_RESAMPLE_METHOD,
+                                     POI_SUBICON_MAP, image_nbytes, map_bg_path, poi_icon_path)
+from src.detector.map_info import (MapPattern, NO_CONSTRUCT, Position, STD_MAP_SIZE, load_map_info)
+from src.detector.utils import (LRUCache, draw_icon, draw_text, grab_region, paste_cv2)
+from src.logger import debug, error, info, is_debug_enabled
 
 CHECK_FULL_MAP_STD_SIZE = (100, 100)
+CHECK_FULL_MAP_HOUGH_MIN_VOTES = 30
+CHECK_FULL_MAP_GATE_THUMBNAIL_SIZE = (16, 16)
+CHECK_FULL_MAP_GATE_LOG_INTERVAL = 200
+# 圆环检查：在标准尺寸中心附近的3x3个候选圆心上按极坐标采样，圆心间距、角度采样数和半径采样范围
+CHECK_FULL_MAP_RING_CENTER_STEP = 8
+CHECK_FULL_MAP_RING_ANGLES = 96
+CHECK_FULL_MAP_RING_RADIUS_RANGE = (34, 56)
+# 径向梯度超过此值且超过切向梯度此倍数的采样点视为圆环边缘
+CHECK_FULL_MAP_RING_EDGE_THRES = 80
+CHECK_FULL_MAP_RING_EDGE_RATIO = 2
+# 圆心不准时圆环在极坐标下会上下起伏，按半径方向±此值合并
+CHECK_FULL_MAP_RING_RADIUS_WINDOW = 2
 
 PREDICT_EARTH_SHIFTING_SIZE = (100, 100)
 PREDICT_EARTH_SHIFTING_SIZE_REGION = (
@@ -41,32 +43,269 @@ PREDICT_EARTH_SHIFTING_SIZE_REGION = (
 )
 PREDICT_EARTH_SHIFTING_OFFSET_AND_STRIDE = (5, 1)
 PREDICT_EARTH_SHIFTING_SCALES = (0.95, 1.05, 7)
-MAP_BGS = {i: open_cv2_image(f"maps/{i}.jpg") for i in range(6) if i != 4}
+
+REGISTER_MAP_SIZE = (250, 250)
+REGISTER_MAP_MAX_SCALE_ERROR = 0.1
+REGISTER_MAP_MAX_SHIFT_RATIO = 0.05
 
 POI_ICON_SCALE = {30: 0.35, 32: 0.5, 34: 0.4, 37: 0.4, 38: 0.3, 40: 0.4, 41: 0.38, }
-POI_ICONS = {ctype: open_pil_image(f"icons/construct/{ctype}.png") for ctype in POI_ICON_SCALE.keys()}
 STD_POI_SIZE = (45, 45)
-ATTRIBUTE_ICONS = [open_pil_image(f"icons/attribute/{i}.png") for i in range(4)]
-CONDITION_ICONS = [open_pil_image(f"icons/condition/{i}.png") for i in range(7)]
-POI_SUBICON_MAP = {
-    30301: ATTRIBUTE_ICONS[1],  # 结晶人要塞-魔
-    32101: ATTRIBUTE_ICONS[0],  # 红狮子营地-火
-    32102: ATTRIBUTE_ICONS[2],  # 骑士营地-雷
-    32200: ATTRIBUTE_ICONS[0],  # 战车营地-火
-    32201: CONDITION_ICONS[3],  # 癫火营地-癫火
-    34001: CONDITION_ICONS[0],  # 鲜血遗迹-出血
-    34002: CONDITION_ICONS[1],  # 萨米尔遗迹-冻伤
-    34003: ATTRIBUTE_ICONS[3],  # 白金遗迹-圣
-    34100: CONDITION_ICONS[5],  # 调香师遗迹-中毒
-    34101: CONDITION_ICONS[5],  # 堕落调香师遗迹-中毒
-    34102: ATTRIBUTE_ICONS[1],  # 法师遗迹-魔
-    34103: CONDITION_ICONS[1],  # 白金射手遗迹-冻伤
-    34104: CONDITION_ICONS[6],  # 卢恩熊遗迹-睡眠
-    34200: CONDITION_ICONS[2],  # 蚯蚓脸遗迹-咒死
-    34300: ATTRIBUTE_ICONS[2],  # 兽人遗迹-雷
-    38000: ATTRIBUTE_ICONS[3],  # 使者教堂-圣
-    38100: ATTRIBUTE_ICONS[0],  # 火焰教堂-火
-}
+POI_DOWNSAMPLE_SIZE = (16, 16)
+POI_MAX_OFFSET_AND_STRIDE = (6, 2)
+# 整体对齐成功后残余偏移较小，只搜索此范围内的偏移；未对齐时搜索全部偏移
+POI_REGISTERED_MAX_OFFSET = 4
+# 偏移按距离从小到大排列，对齐后搜索的偏移是其中的前缀
+POI_OFFSETS = sorted([
+    (dx, dy)
+    for dx in range(-POI_MAX_OFFSET_AND_STRIDE[0], POI_MAX_OFFSET_AND_STRIDE[0] + 1, POI_MAX_OFFSET_AND_STRIDE[1])
+    for dy in range(-POI_MAX_OFFSET_AND_STRIDE[0], POI_MAX_OFFSET_AND_STRIDE[0] + 1, POI_MAX_OFFSET_AND_STRIDE[1])
+], key=lambda offset: max(abs(offset[0]), abs(offset[1])))
+POI_REGISTERED_OFFSET_NUM = sum(max(abs(dx), abs(dy)) <= POI_REGISTERED_MAX_OFFSET for dx, dy in POI_OFFSETS)
+MAP_HASH_SIZE = (9, 8)
+MAP_HASH_MIN_DIFF = 8
+MAP_HASH_POI_MAX_DISTANCE = 3
+# 多帧证据累积：POI分类误差转换为各图标概率时的温度（不低于最小值，并随最佳误差即噪声水平增大）
+POI_EVIDENCE_MIN_TEMPERATURE = 10.0
+POI_EVIDENCE_RELATIVE_TEMPERATURE = 1.0
+# 后验概率与最大值之比不低于此值的候选模式参与选择下一批识别的POI位置
+POI_EVIDENCE_PLAUSIBLE_RATIO = 1e-3
+# POI混淆模型：每种地形生成的合成地图数量、图标随机偏移、截图缩放范围、噪声，以及计数的平滑先验
+POI_CONFUSION_SAMPLES = 48
+POI_CONFUSION_MAX_JITTER = 1
+POI_CONFUSION_CAPTURE_SCALES = (0.8, 1.2)
+POI_CONFUSION_NOISE_STD = 6.0
+POI_CONFUSION_PRIOR = 0.1
+# 混淆模型在后台构建完成之前使用的对称混淆矩阵的正确率（接近实测的平均正确率）
+POI_DEFAULT_CONFUSION_ACCURACY = 0.9
+# 置信度：对数似然除以此温度后再归一化，抵消合成语料与真实截图的差异和POI之间的相关性造成的过度自信
+POI_CONFIDENCE_TEMPERATURE = 4.0
+
+
+def pattern_confidence(loglik: np.ndarray, null_loglik: float) -> np.ndarray:
+    """
+    候选模式的对数似然转换为置信度。除候选模式外还有一个无关假设（每个位置的图标独立地按候选模式的分布出现），
+    截图中与最佳候选不一致的POI较多时置信度降低
+    """
+    loglik = loglik / POI_CONFIDENCE_TEMPERATURE
+    null_loglik = null_loglik / POI_CONFIDENCE_TEMPERATURE
+    m = max(loglik.max(), null_loglik)
+    p = np.exp(loglik - m)
+    return p / (p.sum() + np.exp(null_loglik - m))
+
+
+def null_log_likelihood(candidate_loglik: np.ndarray) -> float:
+    """
+    候选模式在各位置的对数似然 (候选, 位置) 转换为无关假设的对数似然：每个位置取候选之间的平均似然
+    """
+    if candidate_loglik.size == 0:
+        return 0.0
+    m = candidate_loglik.max(axis=0)
+    return float((np.log(np.exp(candidate_loglik - m).mean(axis=0)) + m).sum())
+
+
+def crop_poi_region(img: np.ndarray, pos: Position) -> np.ndarray:
+    x, y = pos[0] - STD_POI_SIZE[0] // 2, pos[1] - STD_POI_SIZE[1] // 2
+    return img[y:y + STD_POI_SIZE[1], x:x + STD_POI_SIZE[0]]
+
+
+@dataclass
+class MapHash:
+    """
+    地图的感知哈希：每个POI位置区域的差值哈希(dHash)，只有相邻差值足够大的位才参与比较
+    """
+    bits: np.ndarray        # (POI位置, 位)
+    reliable: np.ndarray    # (POI位置, 位)
+
+    @staticmethod
+    def compute(img: np.ndarray, positions: list[Position]) -> 'MapHash':
+        """
+        img 为标准尺寸的地图图像
+        """
+        gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+        w, h = MAP_HASH_SIZE
+        diffs = np.empty((len(positions), (w - 1) * h), dtype=np.int16)
+        for i, pos in enumerate(positions):
+            patch = cv2.resize(crop_poi_region(gray, pos), MAP_HASH_SIZE, interpolation=cv2.INTER_AREA).astype(np.int16)
+            diffs[i] = (patch[:, 1:] - patch[:, :-1]).ravel()
+        return MapHash(bits=diffs > 0, reliable=np.abs(diffs) >= MAP_HASH_MIN_DIFF)
+
+    def changed_positions(self, other: 'MapHash') -> int:
+        """
+        汉明距离超过阈值的POI位置数
+        """
+        distance = np.count_nonzero((self.bits != other.bits) & self.reliable & other.reliable, axis=1)
+        return int(np.count_nonzero(distance > MAP_HASH_POI_MAX_DISTANCE))
+
+
+@dataclass
+class PoiCompositeTensor:
+    positions: list[Position]   # 所有POI位置（已排序）
+    ctypes: list[int]           # 所有具有独立图标的POI类型
+    composites: np.ndarray      # (位置, POI类型, 偏移, 16, 16, 3) 背景与图标合成后降采样的图像
+    sqsums: np.ndarray          # (位置, POI类型, 偏移) 每张合成图像的像素平方和
+
+    def to_arrays(self) -> dict[str, np.ndarray]:
+        return {
+            "positions": np.array(self.positions, dtype=np.int32),
+            "ctypes": np.array(self.ctypes, dtype=np.int32),
+            "composites": self.composites,
+            "sqsums": self.sqsums,
+        }
+
+    @staticmethod
+    def from_arrays(arrays: dict[str, np.ndarray]) -> 'PoiCompositeTensor':
+        return PoiCompositeTensor(
+            positions=[(int(x), int(y)) for x, y in arrays["positions"]],
+            ctypes=[int(c) for c in arrays["ctypes"]],
+            composites=arrays["composites"],
+            sqsums=arrays["sqsums"],
+        )
+
+
+@dataclass
+class PatternCodeMatrix:
+    positions: list[Position]       # 所有POI位置（已排序）
+    patterns: list[MapPattern]
+    expected_class: np.ndarray      # (模式, 位置) 期望的建筑类别 (ctype // 1000)，0为空
+    expected_subicon: np.ndarray    # (模式, 位置) 期望的子图标ID，0为无子图标
+    expected_image: np.ndarray      # (模式, 位置) 期望的POI图标在 all_unique_poi_image_ctype 中的下标
+
+
+# POI识别结果与地图模式期望的比较情况编码为：建筑类别相同*4 + 子图标相同*2 + 任一方有子图标
+# 以下为每种情况对应的得分和误差
+POI_MATCH_SCORE_TABLE = np.array([0, 0, 1, 1, 3, 0, 10, 10], dtype=np.int32)
+POI_MATCH_ERROR_TABLE = np.array([10, 10, 3, 3, 1, 10, 0, 0], dtype=np.int32)
+
+
+# 子图标ID的上限，用于将建筑类别和子图标组合为一个编码
+POI_SUBICON_ID_LIMIT = 64
+
+
+@dataclass
+class PatternDecisionIndex:
+    candidates: np.ndarray      # 候选模式在 PatternCodeMatrix 中的下标
+    codes: np.ndarray           # (候选, 位置) 期望建筑类别和子图标的组合编码
+
+    def rank_positions(self, consistent: np.ndarray, classified: np.ndarray) -> list[tuple[int, float]]:
+        """
+        在仍然一致的候选中，计算每个未识别位置的信息增益（期望编码分布的熵），按从大到小排序返回 (位置下标, 信息增益)
+        """
+        codes = self.codes[consistent]
+        gains = []
+        for j in np.flatnonzero(~classified):
+            _, counts = np.unique(codes[:, j], return_counts=True)
+            p = counts / counts.sum()
+            gains.append((int(j), float(-(p * np.log2(p)).sum())))
+        gains.sort(key=lambda x: -x[1])
+        return gains
+
+
+@dataclass
+class MapEvidence:
+    """
+    同一张地图多帧截图累积的识别证据，按帧递增更新
+    """
+    earth_shifting: int
+    manual_constraint: tuple[int] | None
+    poi_loglik: np.ndarray      # (位置, POI图标) 各帧POI分类对数似然之和
+    observed: np.ndarray        # (位置,) 是否在任一帧中被识别
+    pattern_loglik: np.ndarray  # (候选,) 各帧中候选模式的对数似然之和，候选顺序与决策索引一致
+    null_loglik: float = 0.0    # 各帧中无关假设的对数似然之和
+    frames: int = 0
+
+    def copy(self) -> 'MapEvidence':
+        return MapEvidence(
+            earth_shifting=self.earth_shifting,
+            manual_constraint=self.manual_constraint,
+            poi_loglik=self.poi_loglik.copy(),
+            observed=self.observed.copy(),
+            pattern_loglik=self.pattern_loglik.copy(),
+            null_loglik=self.null_loglik,
+            frames=self.frames,
+        )
+
+    def posterior(self, extra_loglik: np.ndarray | None = None, extra_null_loglik: float = 0.0) -> np.ndarray:
+        loglik = self.pattern_loglik if extra_loglik is None else self.pattern_loglik + extra_loglik
+        return pattern_confidence(loglik, self.null_loglik + extra_null_loglik)
+
+
+@dataclass
+class PatternMatch:
+    pattern: MapPattern
+    score: int
+    error: int
+    confidence: float = 0.0  # 在所有候选模式上归一化的后验概率
+
+
+@dataclass
+class FullMapGateStats:
+    checked: int = 0
+    rejected_by_contrast: int = 0
+    rejected_by_edges: int = 0
+    rejected_by_ring: int = 0
+
+
+@dataclass
+class FullMapRingSamples:
+    """
+    完整地图圆环检查的极坐标采样表，所有候选圆心的 (角度, 半径) 采样点纵向拼接，一次 remap 完成采样
+    """
+    map_x: np.ndarray           # (圆心数 * 角度数, 半径数) float32
+    map_y: np.ndarray
+    center_num: int
+    inside: np.ndarray          # (圆心数, 角度数, 半径数) 采样点是否在图像内
+    inside_num: np.ndarray      # (圆心数, 半径数) 每个半径上图像内的角度数
+
+    @staticmethod
+    def build() -> 'FullMapRingSamples':
+        w, h = CHECK_FULL_MAP_STD_SIZE
+        step = CHECK_FULL_MAP_RING_CENTER_STEP
+        centers = [(w / 2 + dx, h / 2 + dy) for dy in (-step, 0, step) for dx in (-step, 0, step)]
+        angles = np.arange(CHECK_FULL_MAP_RING_ANGLES) * (2 * np.pi / CHECK_FULL_MAP_RING_ANGLES)
+        # 两端各多采样一个半径，供Sobel使用
+        radii = np.arange(CHECK_FULL_MAP_RING_RADIUS_RANGE[0] - 1, CHECK_FULL_MAP_RING_RADIUS_RANGE[1] + 1)
+        map_x = np.concatenate([cx + np.cos(angles)[:, None] * radii[None, :] for cx, _ in centers]).astype(np.float32)
+        map_y = np.concatenate([cy + np.sin(angles)[:, None] * radii[None, :] for _, cy in centers]).astype(np.float32)
+        inside = (map_x >= 1) & (map_x <= w - 2) & (map_y >= 1) & (map_y <= h - 2)
+        inside = inside.reshape(len(centers), CHECK_FULL_MAP_RING_ANGLES, -1)[:, :, 1:-1]
+        return FullMapRingSamples(
+            map_x=map_x,
+            map_y=map_y,
+            center_num=len(centers),
+            inside=inside,
+            inside_num=inside.sum(axis=1),
+        )
+
+
+@dataclass
+class MapTransform:
+    """
+    截图（缩放到标准尺寸后）相对于地形背景的相似变换：截图坐标 = scale * 背景坐标 + (dx, dy)
+    """
+    scale: float
+    dx: float
+    dy: float
+    correlation: float  # ECC相关系数
+
+    def to_matrix(self) -> np.ndarray:
+        return np.array([[self.scale, 0, self.dx], [0, self.scale, self.dy]], dtype=np.float32)
+
+
+@dataclass
+class MapPatternCacheEntry:
+    map_hash: MapHash | None
+    earth_shifting: int
+    manual_constraint: tuple[int] | None
+    pattern: MapPattern
+    score: int
+    ranked: list[PatternMatch]
+    transform: MapTransform | None
+
+
+class MapMatchCancelled(Exception):
+    """
+    地图识别被更新的识别请求取代时抛出
+    """
 
 
 @dataclass
@@ -79,6 +318,14 @@ class MapDetectParam:
     do_match_pattern: bool = False
     # 手动限定候选范围：(夜王ID)
     manual_constraint: tuple[int] | None = None
+    # 后台识别时使用：返回True时中止识别，以及识别进度回调 (阶段, 进度0~1)
+    is_cancelled: Callable[[], bool] | None = None
+    on_progress: Callable[[str, float], None] | None = None
+    # 累积多帧的POI分类证据，evidence 为之前帧的结果（为None时开始新的累积）
+    accumulate_evidence: bool = False
+    evidence: MapEvidence | None = None
+    # 重新识别低置信度的结果时不使用模式匹配缓存（结果仍写入缓存）
+    bypass_pattern_cache: bool = False
 
 
 @dataclass
@@ -89,6 +336,12 @@ class MapDetectResult:
     earth_shifting_score: float | None = None
     pattern: MapPattern = None
     pattern_score: int = None
+    ranked_patterns: list[PatternMatch] | None = None  # 置信度最高的前k个候选模式，按置信度从大到小排序
+    map_transform: MapTransform | None = None  # 模式匹配前估计的截图与地形背景的对齐变换
+    pattern_from_cache: bool = False  # 模式匹配结果是否来自缓存
+    pattern_confidence: float | None = None  # 最佳模式的置信度
+    pattern_decided: bool = True  # 多帧累积时是否已经可以确定结果，未确定时不绘制信息
+    evidence: MapEvidence | None = None  # 多帧累积的证据，传入下一帧的识别参数继续累积
     overlay_image: Image.Image = None
 
 
@@ -100,46 +353,193 @@ class MapDetector:
             get_data_path('csv/constructs.csv'),
             get_data_path('csv/names.csv'),
             get_data_path('csv/positions.csv'),
+            cache=MAP_INFO_CACHE,
         )
-        # 处理出所有POI的图标，以及具有独立图标的POI
+        # 处理出具有独立图标的POI，建筑类别和子图标都相同的POI共用一个图标
         self.all_unique_poi_image_ctype: list[int] = []
-        self.all_poi_images: dict[int, Image.Image] = {}
-        self.all_unique_poi_images: dict[int, Image.Image] = {}
+        # 每种POI类型对应的图标在 all_unique_poi_image_ctype 中的下标
+        self.poi_image_index: dict[int, int] = {}
         for ctype in self.info.all_poi_construct_type:
-            same_image_ct = None
-            for ct in self.all_unique_poi_image_ctype:
+            for i, ct in enumerate(self.all_unique_poi_image_ctype):
                 if ctype // 1000 == ct // 1000 \
                         and POI_SUBICON_MAP.get(ctype) == POI_SUBICON_MAP.get(ct):
-                    same_image_ct = ct
+                    self.poi_image_index[ctype] = i
                     break
-            if same_image_ct is None:
-                self.all_unique_poi_image_ctype.append(ctype)
-                self.all_unique_poi_images[ctype] = self._get_poi_image(ctype)
-                self.all_poi_images[ctype] = self.all_unique_poi_images[ctype]
             else:
-                self.all_poi_images[ctype] = self.all_unique_poi_images[same_image_ct]
+                self.poi_image_index[ctype] = len(self.all_unique_poi_image_ctype)
+                self.all_unique_poi_image_ctype.append(ctype)
+        # 独立图标的POI图像，首次使用时绘制
+        self._unique_poi_images: dict[int, Image.Image] | None = None
+        # 将所有地图模式编译为 (模式, POI位置) 的期望建筑类别和子图标矩阵
+        unique_subicons = list(dict.fromkeys(POI_SUBICON_MAP.values()))
+        self.poi_subicon_ids: dict[int, int] = {
+            ctype: unique_subicons.index(subicon) + 1
+            for ctype, subicon in POI_SUBICON_MAP.items()
+        }
+        self.pattern_codes = self._compile_pattern_codes()
+        self.pattern_decision_indices = self._build_pattern_decision_indices()
+        # 每种地形下的POI合成图像张量，首次使用时构建
+        self.poi_composite_tensors: dict[int, PoiCompositeTensor] = {}
+        # 每种地形下的POI分类混淆矩阵 (真实图标, 识别图标) 的对数概率，磁盘缓存中没有时在后台构建
+        self.poi_log_confusions: dict[int, np.ndarray] = {}
+        self.poi_confusion_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="PoiConfusion")
+        self.poi_confusion_futures: dict[int, Future] = {}
+        # POI分类线程池，线程数由配置决定。识别线程和混淆模型构建线程可能同时使用，
+        # 线程数变化后旧的线程池等到没有使用者时才关闭
+        self.poi_match_executor: ThreadPoolExecutor | None = None
+        self.poi_match_executor_workers: int = 0
+        self.poi_match_executor_users: int = 0
+        self.retired_poi_match_executors: list[ThreadPoolExecutor] = []
+        # 地形识别用的背景图像金字塔，首次使用时构建
+        self.earth_shifting_pyramid: dict[int, np.ndarray] | None = None
+        # 地图对齐用的地形背景灰度图，首次使用时构建
+        self.register_refs: dict[int, np.ndarray] = {}
+        # 完整地图判断前置筛选的统计
+        self.full_map_gate_stats = FullMapGateStats()
+        self.full_map_ring_samples = FullMapRingSamples.build()
+        # 最近的模式匹配结果，按使用时间从新到旧排列
+        self.pattern_cache: list[MapPatternCacheEntry] = []
+        # 已绘制的信息图像 {(模式ID, 绘制大小): 图像}，自动识别、后台预绘制和手动选择共用
+        self.overlay_images = LRUCache(max_bytes=Config.get().map_overlay_cache_max_mb * 1024 * 1024, sizeof=image_nbytes)
+        # 后台识别线程与主线程共用上述缓存，延迟构建和缓存读写时加锁
+        self.cache_lock = threading.RLock()
+
+    @property
+    def all_unique_poi_images(self) -> dict[int, Image.Image]:
+        with self.cache_lock:
+            if self._unique_poi_images is None:
+                self._unique_poi_images = {ctype: self._get_poi_image(ctype) for ctype in self.all_unique_poi_image_ctype}
+            return self._unique_poi_images
+
+    def warm_up(self):
+        """
+        预先解码地形背景和图标，并构建地形识别金字塔，避免首次识别时等待。混淆模型不在磁盘缓存中时开始在后台构建
+        """
+        t = time.time()
+        MAP_ASSETS.warm_up(
+            [map_bg_path(i) for i in MAP_BG_IDS],
+            [poi_icon_path(c) for c in POI_ICON_SCALE.keys()] + list(dict.fromkeys(POI_SUBICON_MAP.values())),
+        )
+        self.all_unique_poi_images  # 绘制POI图标
+        with self.cache_lock:
+            if self.earth_shifting_pyramid is None:
+                self.earth_shifting_pyramid = self._build_earth_shifting_pyramid()
+        # 磁盘缓存中没有的混淆模型在后台开始构建
+        for earth_shifting in MAP_BG_IDS:
+            self._get_poi_log_confusion(earth_shifting)
+        info(f"MapDetector: Warm up, time cost: {time.time() - t:.4f}s")
+
+    def _compile_pattern_codes(self) -> PatternCodeMatrix:
+        positions = sorted(self.info.all_poi_pos)
+        patterns = self.info.patterns
+        ctypes = self.info.pattern_table.construct_types[:, self.info.pattern_table.position_columns(positions)]
+        ctypes = np.where(ctypes == NO_CONSTRUCT, 0, ctypes)
+        # 对出现过的建筑类型查表，非POI建筑在地图上没有图标，视为空
+        unique_ctypes, inverse = np.unique(ctypes, return_inverse=True)
+        inverse = inverse.reshape(ctypes.shape)
+        empty_index = self.poi_image_index[0]
+        expected_class = (ctypes // 1000).astype(np.int32)
+        expected_subicon = np.array([self.poi_subicon_ids.get(int(c), 0) for c in unique_ctypes], dtype=np.int32)[inverse]
+        expected_image = np.array([self.poi_image_index.get(int(c), empty_index) for c in unique_ctypes], dtype=np.int32)[inverse]
+        return PatternCodeMatrix(
+            positions=positions,
+            patterns=patterns,
+            expected_class=expected_class,
+            expected_subicon=expected_subicon,
+            expected_image=expected_image,
+        )
+
+    def _check_full_map_gate(self, gray: np.ndarray, magnitude: np.ndarray) -> str | None:
+        """
+        在霍夫圆检测前用廉价的统计量排除明显不是地图的画面，返回排除原因，可能是地图时返回None
+        """
+        config = Config.get()
+        # 缩略图对比度过低（黑屏、加载画面等）
+        thumbnail = cv2.resize(gray, CHECK_FULL_MAP_GATE_THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA)
+        if thumbnail.std() < config.full_map_gate_min_contrast:
+            return "contrast"
+        # 边缘点不足时任何阈值都不可能检测到圆
+        if not any(self._may_have_full_map_circle(magnitude, thres) for thres in config.full_map_hough_circle_thres):
+            return "edges"
+        # 普通画面的边缘点数也足够，需要地图边框的圆环才能区分
+        if self._full_map_ring_coverage(gray) < config.full_map_gate_min_ring_coverage:
+            return "ring"
+        return None
+
+    def _full_map_ring_coverage(self, gray: np.ndarray) -> float:
+        """
+        以中心附近的候选圆心做极坐标展开，统计每个半径上径向边缘占图像内角度的比例，返回所有圆心和半径中的最大值。
+        地图边框的圆环几乎覆盖所有角度，普通画面的边缘方向杂乱，很少在同一半径上连续沿径向排列
+        """
+        samples = self.full_map_ring_samples
+        polar = cv2.remap(gray, samples.map_x, samples.map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+        radial = np.abs(cv2.Sobel(polar, cv2.CV_16S, 1, 0, ksize=3))
+        tangential = np.abs(cv2.Sobel(polar, cv2.CV_16S, 0, 1, ksize=3))
+        edges = (radial > CHECK_FULL_MAP_RING_EDGE_THRES) & (radial > CHECK_FULL_MAP_RING_EDGE_RATIO * tangential)
+        window = np.ones((1, 2 * CHECK_FULL_MAP_RING_RADIUS_WINDOW + 1), dtype=np.uint8)
+        edges = cv2.dilate(edges.astype(np.uint8), window)
+        edges = edges.reshape(samples.center_num, CHECK_FULL_MAP_RING_ANGLES, -1)[:, :, 1:-1]
+        coverage = (edges & samples.inside).sum(axis=1) / np.maximum(samples.inside_num, 1)
+        # 圆环大半在图像外时比例不可靠
+        coverage[samples.inside_num < CHECK_FULL_MAP_RING_ANGLES / 2] = 0
+        return float(coverage.max())
+
+    @staticmethod
+    def _may_have_full_map_circle(magnitude: np.ndarray, thres: int) -> bool:
+        """
+        霍夫梯度法内部使用 Canny(param1 / 2, param1) 得到边缘，每个边缘点对同一圆心至多投一票，
+        因此梯度（L1）超过低阈值的点数不足 param2 时该阈值不可能检测到圆
+        """
+        return np.count_nonzero(magnitude > max(thres / 2, 1)) >= CHECK_FULL_MAP_HOUGH_MIN_VOTES
+
+    def _record_full_map_gate(self, reason: str | None):
+        stats = self.full_map_gate_stats
+        stats.checked += 1
+        if reason == "contrast":
+            stats.rejected_by_contrast += 1
+        elif reason == "edges":
+            stats.rejected_by_edges += 1
+        elif reason == "ring":
+            stats.rejected_by_ring += 1
+        if stats.checked % CHECK_FULL_MAP_GATE_LOG_INTERVAL == 0:
+            rejected = stats.rejected_by_contrast + stats.rejected_by_edges + stats.rejected_by_ring
+            info(f"MapDetector: Full map gate rejected {rejected}/{stats.checked} frames "
+                 f"({rejected / stats.checked:.1%}, contrast: {stats.rejected_by_contrast}, "
+                 f"edges: {stats.rejected_by_edges}, ring: {stats.rejected_by_ring})")
 
     def _match_full_map(self, img: np.ndarray) -> float:
         config = Config.get()
         img = img[-int(img.shape[0] * 0.22):, :int(img.shape[1] * 0.22)]
         img = cv2.resize(img, CHECK_FULL_MAP_STD_SIZE, interpolation=CV2_RESIZE_METHOD)
         gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        circles = []
+        # 梯度只计算一次，前置筛选和每个阈值的边缘点数检查共用
+        dx = cv2.Sobel(gray, cv2.CV_16S, 1, 0, ksize=3)
+        dy = cv2.Sobel(gray, cv2.CV_16S, 0, 1, ksize=3)
+        magnitude = np.abs(dx.astype(np.int32)) + np.abs(dy.astype(np.int32))
+        reason = self._check_full_map_gate(gray, magnitude)
+        self._record_full_map_gate(reason)
+        if reason is not None:
+            debug(f"MapDetector: Full map match skipped by gate: {reason}")
+            return float('inf')
+        circles = None
         for thres in config.full_map_hough_circle_thres:
-            res = cv2.HoughCircles(
+            if not self._may_have_full_map_circle(magnitude, thres):
+                continue
+            circles = cv2.HoughCircles(
                 gray,
                 cv2.HOUGH_GRADIENT,
                 dp=1,
                 minDist=20,
                 param1=thres,
-                param2=30,
+                param2=CHECK_FULL_MAP_HOUGH_MIN_VOTES,
                 minRadius=int(img.shape[0] * 0.4),
                 maxRadius=int(img.shape[0] * 0.5)
             )
-            if res is not None:
-                circles.extend(res)
+            # 只使用第一个检测到圆的阈值的结果，不再计算之后的阈值
+            if circles is not None:
+                break
         error = float('inf')
-        if circles:
+        if circles is not None:
             cx, cy, cr = sorted(list(circles[0]), key=lambda x: x[2], reverse=True)[0]
             # cv2.circle(img, (int(cx), int(cy)), int(cr), (0, 255, 0), 2)
             # cv2.circle(img, (int(cx), int(cy)), 2, (0, 0, 255), 3)
@@ -148,27 +548,60 @@ class MapDetector:
         debug(f"MapDetector: Full map match error: {error:.4f}")
         return error
 
+    def _build_earth_shifting_pyramid(self) -> dict[int, np.ndarray]:
+        """
+        预先将每种地形背景缩放到所有尺度，并裁剪出匹配区域及其偏移余量，
+        返回 {地形: (尺度, 通道, 高, 宽) 的 int16 数组}
+        """
+        x, y, w, h = PREDICT_EARTH_SHIFTING_SIZE_REGION
+        offset, _ = PREDICT_EARTH_SHIFTING_OFFSET_AND_STRIDE
+        min_scale, max_scale, scale_num = PREDICT_EARTH_SHIFTING_SCALES
+        pyramid = {}
+        for map_id in MAP_BG_IDS:
+            map_img = MAP_ASSETS.cv2_image(map_bg_path(map_id))
+            levels = []
+            for scale in np.linspace(min_scale, max_scale, scale_num, endpoint=True):
+                size = (int(PREDICT_EARTH_SHIFTING_SIZE[0] * scale), int(PREDICT_EARTH_SHIFTING_SIZE[1] * scale))
+                map_resized = cv2.resize(map_img, size, interpolation=CV2_RESIZE_METHOD)
+                region = map_resized[y - offset:y + h + offset, x - offset:x + w + offset]
+                levels.append(region.transpose(2, 0, 1))
+            pyramid[map_id] = np.ascontiguousarray(np.stack(levels)).astype(np.int16)
+        return pyramid
+
     def _match_earth_shifting(self, img: np.ndarray) -> tuple[int, float]:
         t = time.time()
+        with self.cache_lock:
+            if self.earth_shifting_pyramid is None:
+                self.earth_shifting_pyramid = self._build_earth_shifting_pyramid()
         img = cv2.resize(img, PREDICT_EARTH_SHIFTING_SIZE, interpolation=CV2_RESIZE_METHOD)
         x, y, w, h = PREDICT_EARTH_SHIFTING_SIZE_REGION
-        img = img[y:y + h, x:x + w].astype(int)
+        img = img[y:y + h, x:x + w].transpose(2, 0, 1).astype(np.int16)
+        _, stride = PREDICT_EARTH_SHIFTING_OFFSET_AND_STRIDE
+        # 中位数取排序后中间的两个值（像素数为偶数时取平均）
+        n = w * h
+        mid = sorted({(n - 1) // 2, n // 2})
         best_map_id, best_score = None, float('inf')
-        offset, stride = PREDICT_EARTH_SHIFTING_OFFSET_AND_STRIDE
-        min_scale, max_scale, scale_num = PREDICT_EARTH_SHIFTING_SCALES
-        for map_id, map_img in MAP_BGS.items():
-            score = float('inf')
-            for scale in np.linspace(min_scale, max_scale, scale_num, endpoint=True):
-                size = (int(PREDICT_EARTH_SHIFTING_SIZE[0] * scale), int(PREDICT_EARTH_SHIFTING_SIZE[1] * scale))
-                map_resized = cv2.resize(map_img, size, interpolation=CV2_RESIZE_METHOD).astype(int)
-                for dx in range(-offset, offset + 1, stride):
-                    for dy in range(-offset, offset + 1, stride):
-                        map_shifted = map_resized[y + dy:y + h + dy, x + dx:x + w + dx]
-                        diff = np.abs((img - map_shifted))
-                        diff[diff > 100] = 0
-                        diff = np.linalg.norm(diff, axis=2)
-                        cur_score = np.median(diff)
-                        score = min(score, cur_score)
+        for map_id, levels in self.earth_shifting_pyramid.items():
+            # 一次计算所有尺度和偏移下每个像素的平方距离: (尺度*dy*dx, 像素)
+            # 单通道差值不超过100，平方和不超过30000，全程使用 int16
+            windows = np.lib.stride_tricks.sliding_window_view(levels, (h, w), axis=(2, 3))[:, :, ::stride, ::stride]
+            diff = np.subtract(windows, img[None, :, None, None], order="C")
+            np.abs(diff, out=diff)
+            np.multiply(diff, diff <= 100, out=diff)
+            np.multiply(diff, diff, out=diff)
+            sqdist = diff.sum(axis=1, dtype=np.int16).reshape(-1, n)
+            if best_map_id is None:
+                # 以平方距离和最小的位置作为初始的最优分数
+                seed = int(np.argmin(sqdist.sum(axis=1, dtype=np.int32)))
+                best_score = float(np.sqrt(np.partition(sqdist[seed], mid)[mid].astype(np.float64)).mean())
+                best_map_id = map_id
+            # 中位数不小于较小的中间值，较小的中间值不超过 best_score^2 的位置才可能更优
+            # 只对这些位置精确计算中位数
+            candidates = np.flatnonzero(np.count_nonzero(sqdist <= int(best_score ** 2), axis=1) > mid[0])
+            if len(candidates) == 0:
+                continue
+            medians = np.partition(sqdist[candidates], mid, axis=1)[:, mid].astype(np.float64)
+            score = float(np.sqrt(medians).mean(axis=1).min())
             # print(f"map {map_id} score: {score:.4f}")
             if score < best_score:
                 best_score = score
@@ -176,11 +609,55 @@ class MapDetector:
         info(f"MapDetector: Match earth shifting: best map {best_map_id} score {best_score:.4f}, time cost: {time.time() - t:.4f}s")
         return best_map_id, best_score
 
+    def _register_map(self, img: np.ndarray, earth_shifting: int) -> MapTransform | None:
+        """
+        估计标准尺寸截图相对于地形背景的平移和缩放：先用相位相关估计平移，再用ECC细化。
+        估计失败或结果不可信时返回None
+        """
+        config = Config.get()
+        t = time.time()
+        with self.cache_lock:
+            if earth_shifting not in self.register_refs:
+                ref = cv2.resize(MAP_ASSETS.cv2_image(map_bg_path(earth_shifting)), REGISTER_MAP_SIZE, interpolation=cv2.INTER_AREA)
+                self.register_refs[earth_shifting] = cv2.cvtColor(ref, cv2.COLOR_RGB2GRAY).astype(np.float32)
+            ref = self.register_refs[earth_shifting]
+        cap = cv2.resize(img, REGISTER_MAP_SIZE, interpolation=cv2.INTER_AREA)
+        cap = cv2.cvtColor(cap, cv2.COLOR_RGB2GRAY).astype(np.float32)
+
+        window = cv2.createHanningWindow(REGISTER_MAP_SIZE, cv2.CV_32F)
+        # phaseCorrelate 会将窗函数原地乘到输入图像上，传入副本
+        (sx, sy), _ = cv2.phaseCorrelate(ref.copy(), cap.copy(), window)
+        warp = np.array([[1, 0, sx], [0, 1, sy]], dtype=np.float32)
+        try:
+            criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 50, 1e-4)
+            correlation, warp = cv2.findTransformECC(ref, cap, warp, cv2.MOTION_AFFINE, criteria, None, 5)
+        except cv2.error as e:
+            info(f"MapDetector: Register map failed: {e}")
+            return None
+
+        # 仿射结果投影到相似变换，平移换算到标准尺寸
+        k = STD_MAP_SIZE[0] / REGISTER_MAP_SIZE[0]
+        transform = MapTransform(
+            scale=float(warp[0, 0] + warp[1, 1]) / 2,
+            dx=float(warp[0, 2]) * k,
+            dy=float(warp[1, 2]) * k,
+            correlation=float(correlation),
+        )
+        info(f"MapDetector: Register map: scale {transform.scale:.4f} shift ({transform.dx:.1f}, {transform.dy:.1f}) "
+             f"correlation {transform.correlation:.4f}, time cost: {time.time() - t:.4f}s")
+        max_shift = STD_MAP_SIZE[0] * REGISTER_MAP_MAX_SHIFT_RATIO
+        if transform.correlation < config.map_register_min_correlation \
+                or abs(transform.scale - 1) > REGISTER_MAP_MAX_SCALE_ERROR \
+                or abs(transform.dx) > max_shift or abs(transform.dy) > max_shift:
+            info("MapDetector: Register map result rejected")
+            return None
+        return transform
+
     def _get_poi_image(self, construct_type: int) -> Image.Image:
         x, y = STD_POI_SIZE[0] // 2, STD_POI_SIZE[1] // 2
         img = Image.new("RGBA", STD_POI_SIZE, (0, 0, 0, 0))
         if construct_type:
-            icon = POI_ICONS[construct_type // 1000]
+            icon = MAP_ASSETS.pil_image(poi_icon_path(construct_type // 1000))
             icon_scale = POI_ICON_SCALE[construct_type // 1000]
             icon_size = (
                 int(icon.size[0] * icon_scale * STD_MAP_SIZE[0] / 750),
@@ -190,7 +667,7 @@ class MapDetector:
             icon_pos = (x - icon_size[0] // 2, y - icon_size[1] // 2)
             img.alpha_composite(icon, icon_pos)
             if construct_type in POI_SUBICON_MAP:
-                subicon = POI_SUBICON_MAP[construct_type]
+                subicon = MAP_ASSETS.pil_image(POI_SUBICON_MAP[construct_type])
                 subicon_size = (
                     int(STD_MAP_SIZE[0] * 0.0185),
                     int(STD_MAP_SIZE[1] * 0.0185),
@@ -203,131 +680,435 @@ class MapDetector:
                 img.alpha_composite(subicon, subicon_pos)
         return img
 
-    def _match_poi(self, map_img: np.ndarray, map_bg: np.ndarray, pos: Position) -> tuple[int, float]:
-        img = map_img[
-            pos[1] - STD_POI_SIZE[1] // 2:pos[1] - STD_POI_SIZE[1] // 2 + STD_POI_SIZE[1],
-            pos[0] - STD_POI_SIZE[0] // 2:pos[0] - STD_POI_SIZE[1] // 2 + STD_POI_SIZE[0],
-        ]
-        bg = map_bg[
-            pos[1] - STD_POI_SIZE[1] // 2:pos[1] - STD_POI_SIZE[1] // 2 + STD_POI_SIZE[1],
-            pos[0] - STD_POI_SIZE[0] // 2:pos[0] - STD_POI_SIZE[1] // 2 + STD_POI_SIZE[0],
-        ]
+    def _build_poi_composite_tensor(self, earth_shifting: int) -> PoiCompositeTensor:
+        """
+        预先计算该地形下每个POI位置、每种POI图标、每个偏移合成到背景上再降采样后的图像
+        """
+        t = time.time()
+        map_bg = cv2.resize(MAP_ASSETS.cv2_image(map_bg_path(earth_shifting)), STD_MAP_SIZE, interpolation=CV2_RESIZE_METHOD)
+        positions = sorted(self.info.all_poi_pos)
+        ctypes = list(self.all_unique_poi_image_ctype)
+        w, h = STD_POI_SIZE
+        dw, dh = POI_DOWNSAMPLE_SIZE
+
+        # 所有图标在所有偏移下平移后的图层 (h, w, 图标 * 偏移, 4)
+        layers = np.zeros((h, w, len(ctypes) * len(POI_OFFSETS), 4), dtype=np.float32)
+        for ci, ctype in enumerate(ctypes):
+            icon = np.array(self.all_unique_poi_images[ctype], dtype=np.float32)
+            for oi, (dx, dy) in enumerate(POI_OFFSETS):
+                layers[max(0, dy):h + min(0, dy), max(0, dx):w + min(0, dx), ci * len(POI_OFFSETS) + oi] = \
+                    icon[max(0, -dy):h - max(0, dy), max(0, -dx):w - max(0, dx)]
+        layer_count = layers.shape[2]
+        # 在图层数组上原地预乘透明度，避免额外的浮点副本
+        layer_alpha = layers[..., 3:] / 255
+        layer_rgb = layers[..., :3]
+        layer_rgb *= layer_alpha
+        layer_rgb += 0.5
+        layer_inv_alpha = 1 - layer_alpha
+        del layer_alpha
+
+        composites = np.empty((len(positions), layer_count, dh, dw, 3), dtype=np.uint8)
+        sqsums = np.empty((len(positions), layer_count), dtype=np.float32)
+        blended = np.empty((h, w, layer_count, 3), dtype=np.float32)
+        for pi, pos in enumerate(positions):
+            bg = crop_poi_region(map_bg, pos).astype(np.float32)
+            np.multiply(layer_inv_alpha, bg[:, :, None, :], out=blended)
+            blended += layer_rgb
+            # 将所有合成结果按通道堆叠后分批缩放（cv2最多支持128通道）
+            stacked = blended.astype(np.uint8).reshape(h, w, -1)
+            resized = np.concatenate([
+                cv2.resize(stacked[..., i:i + 126], POI_DOWNSAMPLE_SIZE, interpolation=CV2_RESIZE_METHOD)
+                for i in range(0, stacked.shape[2], 126)
+            ], axis=2)
+            composites[pi] = resized.reshape(dh, dw, layer_count, 3).transpose(2, 0, 1, 3)
+            # 逐位置计算平方和，避免整个张量的浮点副本
+            flat = composites[pi].reshape(layer_count, -1).astype(np.float32)
+            sqsums[pi] = np.einsum('ld,ld->l', flat, flat)
+
+        composites = composites.reshape(len(positions), len(ctypes), len(POI_OFFSETS), dh, dw, 3)
+        sqsums = sqsums.reshape(len(positions), len(ctypes), len(POI_OFFSETS))
+        info(f"MapDetector: Build POI composite tensor for earth shifting {earth_shifting}, time cost: {time.time() - t:.4f}s")
+        return PoiCompositeTensor(positions=positions, ctypes=ctypes, composites=composites, sqsums=sqsums)
+
+    def _get_poi_composite_tensor(self, earth_shifting: int) -> PoiCompositeTensor:
+        with self.cache_lock:
+            if earth_shifting not in self.poi_composite_tensors:
+                # 优先从磁盘缓存中以内存映射方式加载
+                arrays = MAP_ASSET_CACHE.get_or_create(
+                    f"poi_composites_{earth_shifting}",
+                    lambda: self._build_poi_composite_tensor(earth_shifting).to_arrays(),
+                    params=self._poi_composite_cache_params(),
+                )
+                self.poi_composite_tensors[earth_shifting] = PoiCompositeTensor.from_arrays(arrays)
+            return self.poi_composite_tensors[earth_shifting]
 
-        DOWNSAMPLE_SIZE = (16, 16)
-        MAX_OFFSET = 6
-        OFFSET_STRIDE = 2
-
-        img = cv2.resize(img, DOWNSAMPLE_SIZE, interpolation=CV2_RESIZE_METHOD)
-        bg = Image.fromarray(bg).convert("RGBA")
-
-        # t = Timer()
-        best_ctype = None
-        best_score = float('inf')
-        for ctype, poi_img in self.all_unique_poi_images.items():
-            ctype_score = float('inf')
-            for dx in range(-MAX_OFFSET, MAX_OFFSET + 1, OFFSET_STRIDE):
-                for dy in range(-MAX_OFFSET, MAX_OFFSET + 1, OFFSET_STRIDE):
-                    img2 = bg.copy()
-                    img2.alpha_composite(poi_img, (dx, dy))
-                    img2 = cv2.cvtColor(np.array(img2), cv2.COLOR_RGBA2RGB)
-                    img2 = cv2.resize(img2, DOWNSAMPLE_SIZE, interpolation=CV2_RESIZE_METHOD)
-                    score = np.mean((img.astype(np.float32) - img2.astype(np.float32)) ** 2)
-                    ctype_score = min(ctype_score, score)
-            if ctype_score < best_score:
-                best_score = ctype_score
-                best_ctype = ctype
-            # print(f"construct {ctype} match score: {ctype_score:.4f}")
-            # display_cv2_image(img_rgb, None)
-            # display_cv2_image(img2_rgb, None)
-        # print("best:", best_ctype, best_val)
-        # display_pil_image(all_poi_images[best_ctype], None)
-        # t.print()
-        return best_ctype, best_score
-
-    def _match_map_pattern(self, img: np.ndarray, earth_shifting: int, manual_constraint: tuple[int] | None = None) -> tuple[MapPattern, int]:
+    def _poi_composite_cache_params(self) -> tuple:
+        return (STD_MAP_SIZE, STD_POI_SIZE, POI_DOWNSAMPLE_SIZE, POI_OFFSETS, POI_ICON_SCALE,
+                CV2_RESIZE_METHOD, sorted(self.all_unique_poi_image_ctype))
+
+    def _build_poi_log_confusion(self, earth_shifting: int) -> np.ndarray:
+        """
+        在合成地图语料上估计POI分类的混淆矩阵 (真实图标, 识别图标) 的对数概率。
+        每张合成地图在所有POI位置随机放置图标（带随机偏移），经过截图缩放和噪声后用相同的流程分类
+        """
+        t = time.time()
+        rng = np.random.default_rng(earth_shifting)
+        map_bg = Image.fromarray(cv2.resize(MAP_ASSETS.cv2_image(map_bg_path(earth_shifting)), STD_MAP_SIZE, interpolation=CV2_RESIZE_METHOD)).convert("RGBA")
+        positions = self.pattern_codes.positions
+        ctypes = self.all_unique_poi_image_ctype
+        counts = np.full((len(ctypes), len(ctypes)), POI_CONFUSION_PRIOR, dtype=np.float64)
+        for _ in range(POI_CONFUSION_SAMPLES):
+            truth = rng.integers(len(ctypes), size=len(positions))
+            img = map_bg.copy()
+            for pos, ci in zip(positions, truth):
+                dx, dy = rng.integers(-POI_CONFUSION_MAX_JITTER, POI_CONFUSION_MAX_JITTER + 1, size=2)
+                img.alpha_composite(self.all_unique_poi_images[ctypes[ci]], (
+                    max(0, int(pos[0] - STD_POI_SIZE[0] // 2 + dx)),
+                    max(0, int(pos[1] - STD_POI_SIZE[1] // 2 + dy)),
+                ))
+            img = np.array(img.convert("RGB"))
+            scale = rng.uniform(*POI_CONFUSION_CAPTURE_SCALES)
+            img = cv2.resize(img, (int(STD_MAP_SIZE[0] * scale), int(STD_MAP_SIZE[1] * scale)), interpolation=cv2.INTER_AREA)
+            img = np.clip(img + rng.normal(0, POI_CONFUSION_NOISE_STD, img.shape), 0, 255).astype(np.uint8)
+            img = cv2.resize(img, STD_MAP_SIZE, interpolation=CV2_RESIZE_METHOD)
+            _, scores = self._score_pois(img, earth_shifting)
+            np.add.at(counts, (truth, scores.argmin(axis=1)), 1)
+        info(f"MapDetector: Build POI confusion model for earth shifting {earth_shifting}, "
+             f"accuracy: {np.trace(counts - POI_CONFUSION_PRIOR) / (POI_CONFUSION_SAMPLES * len(positions)):.4f}, "
+             f"time cost: {time.time() - t:.4f}s")
+        return np.log(counts / counts.sum(axis=1, keepdims=True))
+
+    def _poi_confusion_cache_params(self) -> tuple:
+        return (self._poi_composite_cache_params(), POI_CONFUSION_SAMPLES, POI_CONFUSION_MAX_JITTER,
+                POI_CONFUSION_CAPTURE_SCALES, POI_CONFUSION_NOISE_STD, POI_CONFUSION_PRIOR)
+
+    def _default_poi_log_confusion(self) -> np.ndarray:
+        n = len(self.all_unique_poi_image_ctype)
+        confusion = np.full((n, n), (1 - POI_DEFAULT_CONFUSION_ACCURACY) / (n - 1))
+        np.fill_diagonal(confusion, POI_DEFAULT_CONFUSION_ACCURACY)
+        return np.log(confusion)
+
+    def _build_and_save_poi_log_confusion(self, earth_shifting: int):
+        log_confusion = self._build_poi_log_confusion(earth_shifting)
+        MAP_ASSET_CACHE.save(f"poi_confusion_{earth_shifting}", {"log_confusion": log_confusion},
+                             params=self._poi_confusion_cache_params())
+        with self.cache_lock:
+            self.poi_log_confusions[earth_shifting] = log_confusion
+
+    def _get_poi_log_confusion(self, earth_shifting: int) -> np.ndarray:
+        """
+        优先使用内存或磁盘缓存中的混淆模型；都没有时在后台构建（需要数秒），构建完成前使用对称的默认混淆矩阵
+        """
+        with self.cache_lock:
+            if earth_shifting in self.poi_log_confusions:
+                return self.poi_log_confusions[earth_shifting]
+            arrays = MAP_ASSET_CACHE.load(f"poi_confusion_{earth_shifting}", params=self._poi_confusion_cache_params())
+            if arrays is not None:
+                self.poi_log_confusions[earth_shifting] = np.asarray(arrays["log_confusion"])
+                return self.poi_log_confusions[earth_shifting]
+            future = self.poi_confusion_futures.get(earth_shifting)
+            if future is None or (future.done() and future.exception() is not None):
+                if future is not None:
+                    error(f"MapDetector: Build POI confusion model for earth shifting {earth_shifting} failed: {future.exception()!r}")
+                self.poi_confusion_futures[earth_shifting] = self.poi_confusion_executor.submit(
+                    self._build_and_save_poi_log_confusion, earth_shifting)
+            return self._default_poi_log_confusion()
+
+    @contextmanager
+    def _use_poi_match_executor(self) -> Iterator[tuple[ThreadPoolExecutor | None, int]]:
+        """
+        获取POI分类线程池及其线程数（线程数不超过1时线程池为None），使用期间线程池不会被关闭
+        """
+        workers = Config.get().map_poi_match_workers
+        if workers <= 1:
+            yield None, 1
+            return
+        with self.cache_lock:
+            if self.poi_match_executor is None or self.poi_match_executor_workers != workers:
+                if self.poi_match_executor is not None:
+                    self.retired_poi_match_executors.append(self.poi_match_executor)
+                self.poi_match_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="PoiMatch")
+                self.poi_match_executor_workers = workers
+            executor = self.poi_match_executor
+            self.poi_match_executor_users += 1
+        try:
+            yield executor, workers
+        finally:
+            with self.cache_lock:
+                self.poi_match_executor_users -= 1
+                if self.poi_match_executor_users == 0:
+                    for retired in self.retired_poi_match_executors:
+                        retired.shutdown(wait=False)
+                    self.retired_poi_match_executors.clear()
+
+    @staticmethod
+    def _score_poi_chunk(tensor: PoiCompositeTensor, map_img: np.ndarray, indices: list[int], offset_num: int) -> np.ndarray:
+        """
+        计算张量中指定下标的POI位置与每种POI图标在前 offset_num 个偏移下的误差，返回 (位置, POI类型)
+        """
+        patches = np.stack([
+            cv2.resize(crop_poi_region(map_img, tensor.positions[i]), POI_DOWNSAMPLE_SIZE, interpolation=CV2_RESIZE_METHOD)
+            for i in indices
+        ]).reshape(len(indices), -1).astype(np.float32)
+        composites = tensor.composites[indices].reshape(len(indices), *tensor.sqsums.shape[1:], -1)[:, :, :offset_num]
+        cross = np.einsum('pd,pcod->pco', patches, composites)
+        scores = (tensor.sqsums[indices][:, :, :offset_num] - 2 * cross + np.sum(patches ** 2, axis=1)[:, None, None]) / patches.shape[1]
+        return scores.min(axis=2)
+
+    def _score_pois(self, map_img: np.ndarray, earth_shifting: int,
+                    positions: list[Position] | None = None, registered: bool = False) -> tuple[list[int], np.ndarray]:
+        """
+        计算POI位置（默认为所有位置）与每种POI图标的误差（降采样后的MSE，取偏移中的最小值，
+        截图已整体对齐时只搜索较小的偏移），返回位置在张量中的下标（升序）和误差 (位置, POI类型)。
+        位置被分块后交给线程池并行处理
+        """
+        tensor = self._get_poi_composite_tensor(earth_shifting)
+        offset_num = POI_REGISTERED_OFFSET_NUM if registered else len(POI_OFFSETS)
+        if positions is None:
+            indices = list(range(len(tensor.positions)))
+        else:
+            pos_index = {pos: i for i, pos in enumerate(tensor.positions)}
+            indices = sorted(pos_index[pos] for pos in positions)
+        if not indices:
+            return [], np.zeros((0, len(tensor.ctypes)), dtype=np.float32)
+
+        with self._use_poi_match_executor() as (executor, workers):
+            if executor is None:
+                return indices, self._score_poi_chunk(tensor, map_img, indices, offset_num)
+            chunk_num = min(workers, len(indices))
+            chunks = [indices[i::chunk_num] for i in range(chunk_num)]
+            results = list(executor.map(lambda chunk: self._score_poi_chunk(tensor, map_img, chunk, offset_num), chunks))
+        scores = np.empty((len(indices), len(tensor.ctypes)), dtype=results[0].dtype)
+        for i, result in enumerate(results):
+            scores[i::chunk_num] = result
+        return indices, scores
+
+    def _match_map_pattern(self, img: np.ndarray, earth_shifting: int, manual_constraint: tuple[int] | None = None,
+                           param: MapDetectParam | None = None) \
+            -> tuple[MapPattern, int, list[PatternMatch], MapTransform | None]:
         assert earth_shifting is not None, "earth_shifing should be provided when matching map pattern"
 
         t = time.time()
+        self._check_cancelled(param)
+        evidence, _, transform = self._match_pois_until_decided(img, earth_shifting, manual_constraint, param)
+
+        # 匹配地图模式，使用置信度最高的结果
+        ranked = self._rank_map_patterns_by_evidence(evidence)
+        best = ranked[0]
+        for i, match in enumerate(ranked[:Config.get().map_pattern_top_k]):
+            info(f"Match map pattern: top {i + 1} pattern #{match.pattern.id} confidence: {match.confidence:.4f} "
+                 f"score: {match.score} error: {match.error}")
+        info(f"Match map pattern: return pattern #{best.pattern.id}, time cost: {time.time() - t:.4f}s")
+        return best.pattern, best.score, ranked, transform
+
+    def _prepare_map_image(self, img: np.ndarray, earth_shifting: int) -> tuple[np.ndarray, MapTransform | None]:
+        """
+        缩放到标准尺寸，并整体对齐到地形背景，之后POI分类只需搜索较小的偏移
+        """
         img = cv2.resize(img, STD_MAP_SIZE, interpolation=CV2_RESIZE_METHOD)
-
-        # 识别POI
-        map_bg = cv2.resize(MAP_BGS[earth_shifting], STD_MAP_SIZE, interpolation=CV2_RESIZE_METHOD)
+        transform = None
+        if Config.get().map_register_enabled:
+            transform = self._register_map(img, earth_shifting)
+        if transform is not None:
+            img = cv2.warpAffine(img, transform.to_matrix(), STD_MAP_SIZE,
+                                 flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP, borderMode=cv2.BORDER_REPLICATE)
+        return img, transform
+
+    def _build_pattern_decision_indices(self) -> dict[tuple[int, int | None], PatternDecisionIndex]:
+        """
+        为每个 (地形, 夜王) 以及每个地形（夜王未知）建立候选模式的决策索引
+        """
+        codes = self.pattern_codes
+        combined = codes.expected_class * POI_SUBICON_ID_LIMIT + codes.expected_subicon
+        pattern_rows = {id(pattern): i for i, pattern in enumerate(codes.patterns)}
+        indices = {}
+        for earth_shifting in sorted(self.info.patterns_by_earth_shifting):
+            for nightlord in [None] + self.info.get_nightlords(earth_shifting):
+                candidates = np.array([pattern_rows[id(p)] for p in self.info.get_patterns(earth_shifting, nightlord)], dtype=np.int64)
+                indices[(earth_shifting, nightlord)] = PatternDecisionIndex(candidates=candidates, codes=combined[candidates])
+        return indices
+
+    @staticmethod
+    def _poi_log_likelihood(scores: np.ndarray, log_confusion: np.ndarray) -> np.ndarray:
+        """
+        将POI分类误差 (位置, POI类型) 转换为每种真实图标的对数似然。误差先转换为识别为各图标的概率，
+        温度随每个位置的最佳误差增大，被遮挡或模糊的位置得到接近均匀的分布；再经过混淆模型，
+        避免单帧的错误分类完全否定正确的模式
+        """
+        temperature = np.maximum(POI_EVIDENCE_MIN_TEMPERATURE, scores.min(axis=1, keepdims=True) * POI_EVIDENCE_RELATIVE_TEMPERATURE)
+        observed = np.exp(-(scores - scores.min(axis=1, keepdims=True)) / temperature)
+        observed /= observed.sum(axis=1, keepdims=True)
+        return np.log(observed @ np.exp(log_confusion).T)
+
+    def _match_pois_until_decided(self, img: np.ndarray, earth_shifting: int,
+                                  manual_constraint: tuple[int] | None = None,
+                                  param: MapDetectParam | None = None, evidence: MapEvidence | None = None) \
+            -> tuple[MapEvidence, bool, MapTransform | None]:
+        """
+        识别一帧截图的POI并累积到证据中（evidence 为None时开始新的证据）。按信息增益从大到小的顺序分批识别
+        仍可能的候选模式之间有区别的POI，最佳候选的后验概率达到阈值且本帧误差在预算内时提前停止
+        （误差预算为None时识别所有POI）。返回证据、剩余可能的候选是否已无法区分，以及对齐变换
+        """
+        config = Config.get()
+        t = time.time()
+        codes = self.pattern_codes
+        if evidence is None:
+            evidence = self.new_evidence(earth_shifting, manual_constraint)
+        img, transform = self._prepare_map_image(img, evidence.earth_shifting)
+
+        index = self.pattern_decision_indices[(evidence.earth_shifting, evidence.manual_constraint[0] if evidence.manual_constraint else None)]
+        expected_class = codes.expected_class[index.candidates]
+        expected_subicon = codes.expected_subicon[index.candidates]
+        expected_image = codes.expected_image[index.candidates]
+        log_confusion = self._get_poi_log_confusion(evidence.earth_shifting)
+        budget = config.map_pattern_early_stop_error_budget
+        batch_size = max(1, config.map_poi_match_workers)
+        frame_loglik = np.zeros(len(index.candidates), dtype=np.float64)
+        frame_null_loglik = 0.0
+        errors = np.zeros(len(index.candidates), dtype=np.int32)
+        classified = np.zeros(len(codes.positions), dtype=bool)
         poi_result: dict[Position, int] = {}
-        poi_result_img = img.copy()  # for debug
-
-        for x, y in sorted(self.info.all_poi_pos):
-            ctype, score = self._match_poi(img, map_bg, (x, y))
-            poi_result[(x, y)] = ctype
-            paste_cv2(poi_result_img, np.array(self.all_unique_poi_images[ctype])[..., :3], (x - STD_POI_SIZE[0] // 2, y - STD_POI_SIZE[1] // 2))
-            # info(f"pos {x},{y} match construct {ctype} with score {score:.4f}")
+        while not classified.all():
+            if budget is None:
+                batch = np.flatnonzero(~classified).tolist()
+            else:
+                posterior = evidence.posterior(frame_loglik, frame_null_loglik)
+                best = posterior.argmax()
+                if posterior[best] >= config.map_evidence_min_confidence and errors[best] <= budget:
+                    break
+                plausible = posterior >= posterior[best] * POI_EVIDENCE_PLAUSIBLE_RATIO
+                ranked_positions = index.rank_positions(plausible, classified)
+                if ranked_positions[0][1] <= 0:
+                    break
+                batch = [j for j, gain in ranked_positions[:batch_size] if gain > 0]
+            self._check_cancelled(param)
+            self._report_progress(param, "pattern", classified.sum() / len(classified))
+            batch, scores = self._score_pois(img, evidence.earth_shifting, [codes.positions[j] for j in batch], transform is not None)
+            loglik = self._poi_log_likelihood(scores, log_confusion)
+            evidence.poi_loglik[batch] += loglik
+            evidence.observed[batch] = True
+            candidate_loglik = loglik[np.arange(len(batch)), expected_image[:, batch]]
+            frame_loglik += candidate_loglik.sum(axis=1)
+            frame_null_loglik += null_log_likelihood(candidate_loglik)
+            # 本帧的分类结果（误差最小的图标）用于误差预算和调试图像
+            observed = np.array([self.all_unique_poi_image_ctype[i] for i in scores.argmin(axis=1)], dtype=np.int32)
+            case = self._poi_match_case(expected_class[:, batch], expected_subicon[:, batch], observed)
+            errors += POI_MATCH_ERROR_TABLE[case].sum(axis=1)
+            poi_result.update((codes.positions[j], int(ctype)) for j, ctype in zip(batch, observed))
+            classified[batch] = True
+        evidence.pattern_loglik += frame_loglik
+        evidence.null_loglik += frame_null_loglik
+        evidence.frames += 1
+
+        posterior = evidence.posterior()
+        plausible = posterior >= posterior.max() * POI_EVIDENCE_PLAUSIBLE_RATIO
+        exhausted = index.rank_positions(plausible, np.zeros(len(codes.positions), dtype=bool))[0][1] <= 0
 
         # 保存结果用于调试
-        cv2.imwrite(get_appdata_path(f"map.jpg"), cv2.cvtColor(img, cv2.COLOR_RGB2BGR))
-        cv2.imwrite(get_appdata_path(f"map_poi_result.jpg"), cv2.cvtColor(poi_result_img, cv2.COLOR_RGB2BGR))
-
-        # 匹配地图模式
-        EMPTY_CONSTRUCTION = Construct(type=0, pos=0, is_display=False)
-        best_pattern_by_score, best_score = None, 0
-        best_pattern_by_error, best_error = None, 1e9
-        for pattern in self.info.patterns:
-            if pattern.earth_shifting != earth_shifting:
-                continue
-            if manual_constraint is not None and pattern.nightlord != manual_constraint[0]:
-                continue
-            score, error = 0, 0
-            for pos, ctype in poi_result.items():
-                expect_ctype = pattern.pos_constructions.get(pos, EMPTY_CONSTRUCTION).type
-                subicon = POI_SUBICON_MAP.get(ctype)
-                expect_subicon = POI_SUBICON_MAP.get(expect_ctype)
-                if ctype // 1000 != expect_ctype // 1000:  # 建筑类型不符合
-                    if subicon == expect_subicon:
-                        score += 1  # 子图标符合
-                        error += 3
-                    else:
-                        score += 0
-                        error += 10
-                else:
-                    if subicon == expect_subicon:
-                        score += 10  # 完全符合
-                        error += 0
-                    elif subicon or expect_subicon:
-                        score += 0  # 一个有子图标一个没有
-                        error += 10
-                    else:
-                        score += 3  # 子图标不符合
-                        error += 1
-
-            # info(f"pattern {pattern.id} match score: {score} error: {error}")
-            if score > best_score:
-                best_score = score
-                best_pattern_by_score = pattern
-            if error < best_error:
-                best_error = error
-                best_pattern_by_error = pattern
+        save_debug_image("map.jpg", img)
+        if is_debug_enabled():
+            poi_result_img = img.copy()
+            for (x, y), ctype in poi_result.items():
+                paste_cv2(poi_result_img, np.array(self.all_unique_poi_images[ctype])[..., :3], (x - STD_POI_SIZE[0] // 2, y - STD_POI_SIZE[1] // 2))
+            save_debug_image("map_poi_result.jpg", poi_result_img)
+        info(f"Match map pattern: frame {evidence.frames} classified {classified.sum()}/{len(classified)} POIs, "
+             f"best pattern #{codes.patterns[index.candidates[posterior.argmax()]].id} confidence: {posterior.max():.4f}, "
+             f"time cost: {time.time() - t:.4f}s")
+        return evidence, exhausted, transform
+
+    def _rank_map_patterns_by_evidence(self, evidence: MapEvidence) -> list[PatternMatch]:
+        """
+        以各位置累积似然最大的POI类型作为识别结果计算得分和误差，
+        返回按后验概率从大到小（相同时按误差从小到大）排序的列表
+        """
+        codes = self.pattern_codes
+        index = self.pattern_decision_indices[(evidence.earth_shifting, evidence.manual_constraint[0] if evidence.manual_constraint else None)]
+        best_images = evidence.poi_loglik.argmax(axis=1)
+        poi_result = {
+            codes.positions[j]: self.all_unique_poi_image_ctype[best_images[j]]
+            for j in np.flatnonzero(evidence.observed)
+        }
+        scores, errors = self._score_map_patterns(poi_result, index)
+        posterior = evidence.posterior()
+        return [
+            PatternMatch(pattern=codes.patterns[index.candidates[i]], score=int(scores[i]), error=int(errors[i]), confidence=float(posterior[i]))
+            for i in np.lexsort((errors, -posterior))
+        ]
+
+    def new_evidence(self, earth_shifting: int, manual_constraint: tuple[int] | None = None) -> MapEvidence:
+        index = self.pattern_decision_indices[(earth_shifting, manual_constraint[0] if manual_constraint else None)]
+        positions = len(self.pattern_codes.positions)
+        return MapEvidence(
+            earth_shifting=earth_shifting,
+            manual_constraint=manual_constraint,
+            poi_loglik=np.zeros((positions, len(self.all_unique_poi_image_ctype)), dtype=np.float64),
+            observed=np.zeros(positions, dtype=bool),
+            pattern_loglik=np.zeros(len(index.candidates), dtype=np.float64),
+        )
 
-        # 使用Error最小的结果
-        best_pattern = best_pattern_by_error
-        info(f"Match map pattern: best pattern by score: #{best_pattern_by_score.id} score: {best_score}")
-        info(f"Match map pattern: best pattern by error: #{best_pattern_by_error.id} error: {best_error}")
-        info(f"Match map pattern: return pattern #{best_pattern.id}, time cost: {time.time() - t:.4f}s")
-        return best_pattern, best_score
+    def _poi_match_case(self, expected_class: np.ndarray, expected_subicon: np.ndarray,
+                        observed: int | np.ndarray) -> np.ndarray:
+        """
+        计算POI识别结果与期望的比较情况编码，用于查询得分和误差表
+        """
+        observed = np.asarray(observed)
+        observed_class = observed // 1000
+        observed_subicon = np.vectorize(lambda c: self.poi_subicon_ids.get(int(c), 0), otypes=[np.int32])(observed)
+        return (expected_class == observed_class) * 4 \
+            + (expected_subicon == observed_subicon) * 2 \
+            + ((expected_subicon > 0) | (observed_subicon > 0))
+
+    def _score_map_patterns(self, poi_result: dict[Position, int], index: PatternDecisionIndex) -> tuple[np.ndarray, np.ndarray]:
+        """
+        对决策索引中的所有候选模式同时计算在已识别位置上的得分和误差
+        """
+        codes = self.pattern_codes
+        candidates = index.candidates
+        columns = [j for j, pos in enumerate(codes.positions) if pos in poi_result]
+        observed = np.array([poi_result[codes.positions[j]] for j in columns], dtype=np.int32)
+        case = self._poi_match_case(
+            codes.expected_class[np.ix_(candidates, columns)],
+            codes.expected_subicon[np.ix_(candidates, columns)],
+            observed,
+        )
+        return POI_MATCH_SCORE_TABLE[case].sum(axis=1), POI_MATCH_ERROR_TABLE[case].sum(axis=1)
 
-    def match_map_pattern_all_candidates(self, nightlord: int, earth_shifting: int) -> list[MapPattern]:
+    def match_map_pattern_all_candidates(self, nightlord: int, earth_shifting: int,
+                                         ranked: list[PatternMatch] | None = None) -> list[MapPattern]:
         """
-        获取所有符合条件的候选地图（用于手动选择模式）
+        获取所有符合条件的候选地图（用于手动选择模式），提供之前自动识别的 ranked 时按置信度从大到小排列
         """
         assert nightlord is not None, "nightlord should be provided when match_map_pattern_all_candidates"
         assert earth_shifting is not None, "earth_shifting should be provided when match_map_pattern_all_candidates"
 
-        candidates: list[MapPattern] = []
-        for pattern in self.info.patterns:
-            if pattern.nightlord == nightlord and pattern.earth_shifting == earth_shifting:
-                candidates.append(pattern)
-
-        candidates.sort(key=lambda p: p.id)
+        # 索引中的列表已按ID排序
+        candidates = list(self.info.get_patterns(earth_shifting, nightlord))
+        if ranked:
+            confidences = {m.pattern.id: m.confidence for m in ranked}
+            candidates.sort(key=lambda p: -confidences.get(p.id, 0.0))
 
         return candidates
 
+    def get_overlay_draw_size(self, map_region: tuple[int]) -> tuple[int, int]:
+        config = Config.get()
+        if config.fixed_map_overlay_draw_size is not None:
+            return tuple(config.fixed_map_overlay_draw_size)
+        if config.map_overlay_draw_size_ratio is not None:
+            return (
+                int(map_region[2] * config.map_overlay_draw_size_ratio),
+                int(map_region[3] * config.map_overlay_draw_size_ratio),
+            )
+        return STD_MAP_SIZE
+
+    def has_overlay_image(self, pattern: MapPattern, draw_size: tuple[int, int]) -> bool:
+        return (pattern.id, tuple(draw_size)) in self.overlay_images
+
+    def get_overlay_image(self, pattern: MapPattern, draw_size: tuple[int, int]) -> Image.Image:
+        """
+        返回模式在该绘制大小下的信息图像，已绘制过的直接从缓存中取出。返回的图像共享，不能原地修改
+        """
+        return self.overlay_images.get_or_create((pattern.id, tuple(draw_size)), lambda: self.draw_overlay_image(pattern, draw_size))
+
     def draw_overlay_image(self, pattern: MapPattern, draw_size: tuple[int, int]) -> Image.Image:
         def scale_size(p: int | float | Position) -> int | Position:
             # 以750x750为标准尺寸
@@ -336,7 +1117,7 @@ class MapDetector:
             return (int(p[0] * draw_size[0] / 750), int(p[1] * draw_size[1] / 750))
 
         def open_with_draw_size(path: str, size: tuple[int, int]) -> Image.Image:
-            return open_pil_image(path, scale_size(size))
+            return MAP_OVERLAY_SPRITES.pil_image(path, scale_size(size))
 
         def get_name(ctype: int) -> str:
             return self.info.get_name(ctype) or str(ctype)
@@ -481,11 +1262,41 @@ class MapDetector:
         info(f"Draw overlay image size: {draw_size} time cost: {time.time() - t:.4f}s")
 
         # 保存结果用于调试
-        img.convert('RGB').save(get_appdata_path(f"map_overlay_result.jpg"))
+        save_debug_image("map_overlay_result.jpg", img)
 
         return img
 
+    def _lookup_pattern_cache(self, map_hash: MapHash, earth_shifting: int,
+                              manual_constraint: tuple[int] | None) -> MapPatternCacheEntry | None:
+        config = Config.get()
+        for i, entry in enumerate(self.pattern_cache):
+            if entry.earth_shifting != earth_shifting or entry.manual_constraint != manual_constraint:
+                continue
+            changed = entry.map_hash.changed_positions(map_hash)
+            debug(f"MapDetector: Pattern cache #{entry.pattern.id} changed POIs: {changed}")
+            if changed <= config.map_pattern_cache_max_changed_pois:
+                self.pattern_cache.insert(0, self.pattern_cache.pop(i))
+                return entry
+        return None
+
+    def _insert_pattern_cache(self, entry: MapPatternCacheEntry):
+        self.pattern_cache.insert(0, entry)
+        del self.pattern_cache[Config.get().map_pattern_cache_size:]
+
+    @staticmethod
+    def _check_cancelled(param: MapDetectParam | None):
+        if param is not None and param.is_cancelled is not None and param.is_cancelled():
+            raise MapMatchCancelled()
+
+    @staticmethod
+    def _report_progress(param: MapDetectParam | None, stage: str, progress: float):
+        if param is not None and param.on_progress is not None:
+            param.on_progress(stage, progress)
+
     def detect(self, sct: MSSBase, param: MapDetectParam | None) -> MapDetectResult:
+        """
+        param.is_cancelled 返回True时在各阶段之间抛出 MapMatchCancelled
+        """
         config = Config.get()
         ret = MapDetectResult()
         if param is None or param.map_region is None:
@@ -505,6 +1316,8 @@ class MapDetector:
 
         # 判断特殊地形
         if param.do_match_earth_shifting:
+            self._check_cancelled(param)
+            self._report_progress(param, "earth_shifting", 0.0)
             earth_shifting, earth_shifting_score = self._match_earth_shifting(img)
             if earth_shifting_score > config.earth_shifting_error_threshold:
                 earth_shifting = None
@@ -513,20 +1326,74 @@ class MapDetector:
 
         # 地图模式匹配
         if param.do_match_pattern:
-            pattern, score = self._match_map_pattern(img, param.earth_shifting, param.manual_constraint)
-            ret.pattern = pattern
-            ret.pattern_score = score
-
-            # 决定信息绘制大小
-            if config.fixed_map_overlay_draw_size is not None:
-                draw_size = tuple(config.fixed_map_overlay_draw_size)
-            elif config.map_overlay_draw_size_ratio is not None:
-                draw_size = (
-                    int(param.map_region[2] * config.map_overlay_draw_size_ratio),
-                    int(param.map_region[3] * config.map_overlay_draw_size_ratio),
+            self._check_cancelled(param)
+            self._report_progress(param, "pattern", 0.0)
+            # 同一局游戏中地图不变，感知哈希相近时直接使用之前的结果
+            use_cache = config.map_pattern_cache_size > 0
+            map_hash, entry = None, None
+            if use_cache:
+                map_hash = MapHash.compute(cv2.resize(img, STD_MAP_SIZE, interpolation=cv2.INTER_AREA), self.pattern_codes.positions)
+                if not param.bypass_pattern_cache:
+                    with self.cache_lock:
+                        entry = self._lookup_pattern_cache(map_hash, param.earth_shifting, param.manual_constraint)
+            accumulate = param.accumulate_evidence and config.map_evidence_max_frames > 1
+            if entry is not None:
+                info(f"Match map pattern: use cached pattern #{entry.pattern.id}")
+                ret.pattern_from_cache = True
+            elif accumulate:
+                evidence = param.evidence
+                if evidence is None or evidence.earth_shifting != param.earth_shifting \
+                        or evidence.manual_constraint != param.manual_constraint:
+                    evidence = self.new_evidence(param.earth_shifting, param.manual_constraint)
+                else:
+                    # 识别可能被取消，不修改传入的证据
+                    evidence = evidence.copy()
+                evidence, exhausted, transform = self._match_pois_until_decided(
+                    img, param.earth_shifting, param.manual_constraint, param, evidence)
+                ranked = self._rank_map_patterns_by_evidence(evidence)
+                ret.evidence = evidence
+                ret.pattern_decided = exhausted or evidence.frames >= config.map_evidence_max_frames \
+                    or ranked[0].confidence >= config.map_evidence_min_confidence
+                entry = MapPatternCacheEntry(
+                    map_hash=map_hash,
+                    earth_shifting=param.earth_shifting,
+                    manual_constraint=param.manual_constraint,
+                    pattern=ranked[0].pattern,
+                    score=ranked[0].score,
+                    ranked=ranked[:config.map_pattern_top_k],
+                    transform=transform,
                 )
+                if use_cache and ret.pattern_decided:
+                    with self.cache_lock:
+                        self._insert_pattern_cache(entry)
             else:
-                draw_size = STD_MAP_SIZE
-            ret.overlay_image = self.draw_overlay_image(pattern, draw_size)
+                pattern, score, ranked, transform = self._match_map_pattern(img, param.earth_shifting, param.manual_constraint, param)
+                entry = MapPatternCacheEntry(
+                    map_hash=map_hash,
+                    earth_shifting=param.earth_shifting,
+                    manual_constraint=param.manual_constraint,
+                    pattern=pattern,
+                    score=score,
+                    ranked=ranked[:config.map_pattern_top_k],
+                    transform=transform,
+                )
+                if use_cache:
+                    with self.cache_lock:
+                        self._insert_pattern_cache(entry)
+            ret.pattern = entry.pattern
+            ret.pattern_score = entry.score
+            ret.ranked_patterns = entry.ranked
+            ret.pattern_confidence = entry.ranked[0].confidence
+            ret.map_transform = entry.transform
+            if not ret.pattern_decided:
+                # 等待下一帧继续累积，暂不绘制
+                return ret
+
+            # 决定信息绘制大小
+            draw_size = self.get_overlay_draw_size(param.map_region)
+            if not self.has_overlay_image(entry.pattern, draw_size):
+                self._check_cancelled(param)
+                self._report_progress(param, "overlay", 1.0)
+            ret.overlay_image = self.get_overlay_image(entry.pattern, draw_size)
 
         return ret
@@ -1,5 +1,10 @@
 from dataclasses import dataclass, field
 import csv
+import os
+
+import numpy as np
+
+from src.detector.asset_cache import AssetCache
 
 Position = tuple[int, int]
 
@@ -12,45 +17,229 @@ class Construct:
     pos: Position
     is_display: bool
 
+# 地图模式表的标量字段，位置字段为 (x, y)
+PATTERN_DTYPE = np.dtype([
+    ('id', np.int32),
+    ('nightlord', np.int32),
+    ('earth_shifting', np.int32),
+    ('start_pos', np.int32, (2,)),
+    ('day1_boss', np.int32),
+    ('day1_extra_boss', np.int32),
+    ('day1_pos', np.int32, (2,)),
+    ('day2_boss', np.int32),
+    ('day2_extra_boss', np.int32),
+    ('day2_pos', np.int32, (2,)),
+    ('treasure', np.int32),
+    ('rot_rew', np.int32),
+    ('event_value', np.int32),
+    ('event_flag', np.int32),
+    ('evpat_value', np.int32),
+    ('evpat_flag', np.int32),
+])
+
+# 建筑矩阵中表示该位置没有建筑
+NO_CONSTRUCT = -1
+
+
 @dataclass
+class MapPatternTable:
+    """
+    列式存储的地图模式数据库
+    """
+    scalars: np.ndarray             # (模式,) PATTERN_DTYPE 结构化数组
+    construct_pos: np.ndarray       # (位置, 2) 所有建筑位置（按坐标排序）
+    construct_types: np.ndarray     # (模式, 位置) 建筑类型，NO_CONSTRUCT 为没有建筑
+    construct_display: np.ndarray   # (模式, 位置) 建筑是否显示
+
+    def position_columns(self, positions: list[Position]) -> np.ndarray:
+        """
+        位置在建筑矩阵中的列下标
+        """
+        column = {(int(x), int(y)): j for j, (x, y) in enumerate(self.construct_pos)}
+        return np.array([column[pos] for pos in positions], dtype=np.int64)
+
+
+def _scalar_field(name: str) -> property:
+    return property(lambda self: int(self.table.scalars[name][self.row]))
+
+
+def _pos_field(name: str) -> property:
+    return property(lambda self: tuple(int(v) for v in self.table.scalars[name][self.row]))
+
+
 class MapPattern:
-    id: int
-    nightlord: int
-    earth_shifting: int
-    start_pos: Position
-    day1_boss: int
-    day1_extra_boss: int
-    day1_pos: Position
-    day2_boss: int
-    day2_extra_boss: int
-    day2_pos: Position
-    treasure: int
-    rot_rew: int
-    event_value: int
-    event_flag: int
-    evpat_value: int
-    evpat_flag: int
-    pos_constructions: dict[Position, Construct]
-    
+    """
+    地图模式表中一行的视图，字段在访问时从 MapPatternTable 中读取。
+    与原先的数据类一样按值比较：所有字段和建筑相同的视图相等，哈希只使用ID
+    """
+    __slots__ = ('table', 'row')
+
+    id = _scalar_field('id')
+    nightlord = _scalar_field('nightlord')
+    earth_shifting = _scalar_field('earth_shifting')
+    start_pos = _pos_field('start_pos')
+    day1_boss = _scalar_field('day1_boss')
+    day1_extra_boss = _scalar_field('day1_extra_boss')
+    day1_pos = _pos_field('day1_pos')
+    day2_boss = _scalar_field('day2_boss')
+    day2_extra_boss = _scalar_field('day2_extra_boss')
+    day2_pos = _pos_field('day2_pos')
+    treasure = _scalar_field('treasure')
+    rot_rew = _scalar_field('rot_rew')
+    event_value = _scalar_field('event_value')
+    event_flag = _scalar_field('event_flag')
+    evpat_value = _scalar_field('evpat_value')
+    evpat_flag = _scalar_field('evpat_flag')
+
+    def __init__(self, table: MapPatternTable, row: int):
+        self.table = table
+        self.row = row
+
+    @property
+    def pos_constructions(self) -> dict[Position, Construct]:
+        """
+        该模式的所有建筑，每次访问时重新构建
+        """
+        types = self.table.construct_types[self.row]
+        constructs = {}
+        for j in np.flatnonzero(types != NO_CONSTRUCT):
+            pos = (int(self.table.construct_pos[j, 0]), int(self.table.construct_pos[j, 1]))
+            constructs[pos] = Construct(type=int(types[j]), pos=pos, is_display=bool(self.table.construct_display[self.row, j]))
+        return constructs
+
+    def _fields(self) -> tuple:
+        return tuple(getattr(self, name) for name in PATTERN_DTYPE.names)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, MapPattern):
+            return NotImplemented
+        if self.table is other.table and self.row == other.row:
+            return True
+        return self._fields() == other._fields() and self.pos_constructions == other.pos_constructions
+
+    def __hash__(self) -> int:
+        return hash(self.id)
+
+    def __repr__(self) -> str:
+        return f"MapPattern(id={self.id}, nightlord={self.nightlord}, earth_shifting={self.earth_shifting})"
+
+
 @dataclass
 class MapInfo:
     name_dict: dict[int, str]
     pos_dict: dict[int, Position]
     patterns: list[MapPattern]
+    pattern_table: MapPatternTable
 
     all_poi_pos: set[Position]
     all_poi_construct_type: set[int]
 
+    # 按 (夜王, 地形) 以及按地形索引的模式列表，均按ID排序
+    patterns_by_nightlord_earth_shifting: dict[tuple[int, int], list[MapPattern]] = field(default_factory=dict)
+    patterns_by_earth_shifting: dict[int, list[MapPattern]] = field(default_factory=dict)
+
     def get_name(self, map_id: int) -> str:
         return self.name_dict.get(map_id)
 
+    def get_patterns(self, earth_shifting: int, nightlord: int | None = None) -> list[MapPattern]:
+        """
+        获取符合条件的模式（夜王为None时不限夜王），返回的列表不应被修改
+        """
+        if nightlord is None:
+            return self.patterns_by_earth_shifting.get(earth_shifting, [])
+        return self.patterns_by_nightlord_earth_shifting.get((nightlord, earth_shifting), [])
+
+    def get_nightlords(self, earth_shifting: int) -> list[int]:
+        return sorted(nightlord for nightlord, es in self.patterns_by_nightlord_earth_shifting if es == earth_shifting)
+
+    def to_arrays(self) -> dict[str, np.ndarray]:
+        return {
+            "name_ids": np.array(list(self.name_dict.keys()), dtype=np.int32),
+            "names": np.array(list(self.name_dict.values()), dtype=np.str_),
+            "pos_ids": np.array(list(self.pos_dict.keys()), dtype=np.int32),
+            "pos_coords": np.array(list(self.pos_dict.values()), dtype=np.int32).reshape(-1, 2),
+            "scalars": self.pattern_table.scalars,
+            "construct_pos": self.pattern_table.construct_pos,
+            "construct_types": self.pattern_table.construct_types,
+            "construct_display": self.pattern_table.construct_display,
+            "all_poi_pos": np.array(sorted(self.all_poi_pos), dtype=np.int32).reshape(-1, 2),
+            "all_poi_construct_type": np.array(sorted(self.all_poi_construct_type), dtype=np.int32),
+        }
+
+    @staticmethod
+    def from_arrays(arrays: dict[str, np.ndarray]) -> 'MapInfo':
+        return _make_map_info(
+            name_dict=dict(zip(arrays["name_ids"].tolist(), arrays["names"].tolist())),
+            pos_dict={i: (x, y) for i, (x, y) in zip(arrays["pos_ids"].tolist(), arrays["pos_coords"].tolist())},
+            pattern_table=MapPatternTable(
+                scalars=arrays["scalars"],
+                construct_pos=arrays["construct_pos"],
+                construct_types=arrays["construct_types"],
+                construct_display=arrays["construct_display"],
+            ),
+            all_poi_pos={(x, y) for x, y in arrays["all_poi_pos"].tolist()},
+            all_poi_construct_type=set(arrays["all_poi_construct_type"].tolist()),
+        )
+
+
+def _make_map_info(
+    name_dict: dict[int, str],
+    pos_dict: dict[int, Position],
+    pattern_table: MapPatternTable,
+    all_poi_pos: set[Position],
+    all_poi_construct_type: set[int],
+) -> MapInfo:
+    """
+    创建模式视图并建立索引
+    """
+    patterns = [MapPattern(pattern_table, i) for i in range(len(pattern_table.scalars))]
+    patterns_by_nightlord_earth_shifting: dict[tuple[int, int], list[MapPattern]] = {}
+    patterns_by_earth_shifting: dict[int, list[MapPattern]] = {}
+    nightlords = pattern_table.scalars['nightlord'].tolist()
+    earth_shiftings = pattern_table.scalars['earth_shifting'].tolist()
+    for i in np.argsort(pattern_table.scalars['id'], kind='stable').tolist():
+        patterns_by_nightlord_earth_shifting.setdefault((nightlords[i], earth_shiftings[i]), []).append(patterns[i])
+        patterns_by_earth_shifting.setdefault(earth_shiftings[i], []).append(patterns[i])
+
+    return MapInfo(
+        name_dict=name_dict,
+        pos_dict=pos_dict,
+        patterns=patterns,
+        pattern_table=pattern_table,
+        all_poi_pos=all_poi_pos,
+        all_poi_construct_type=all_poi_construct_type,
+        patterns_by_nightlord_earth_shifting=patterns_by_nightlord_earth_shifting,
+        patterns_by_earth_shifting=patterns_by_earth_shifting,
+    )
+
 
 def load_map_info(
     map_patterns_csv_path: str,
     constructs_csv_path: str,
     names_csv_path: str,
     positions_csv_path: str,
-):
+    cache: AssetCache | None = None,
+) -> MapInfo:
+    """
+    读取地图信息。提供 cache 时优先读取编译好的二进制缓存，CSV变化后缓存自动失效并重新编译
+    """
+    paths = (map_patterns_csv_path, constructs_csv_path, names_csv_path, positions_csv_path)
+    if cache is None:
+        return _parse_map_info_csv(*paths)
+    arrays = cache.get_or_create(
+        "map_info",
+        lambda: _parse_map_info_csv(*paths).to_arrays(),
+        params=([os.path.basename(path) for path in paths], PATTERN_DTYPE.descr),
+    )
+    return MapInfo.from_arrays(arrays)
+
+
+def _parse_map_info_csv(
+    map_patterns_csv_path: str,
+    constructs_csv_path: str,
+    names_csv_path: str,
+    positions_csv_path: str,
+) -> MapInfo:
     with open(names_csv_path, 'r', encoding='utf-8') as f:
         f.readline()
         reader = csv.reader(f)
@@ -69,50 +258,66 @@ def load_map_info(
     with open(constructs_csv_path, 'r', encoding='utf-8') as f:
         f.readline()
         reader = csv.reader(f)
-        map_construct_dict: dict[int, list[Construct]] = {}
+        construct_rows = []  # (地图ID, 类型, 位置列号, 是否显示)
+        pos_columns: dict[Position, int] = {}  # 位置 → 按首次出现顺序的列号
         all_poi_pos, all_poi_construct_type = set(), set()
         for row in reader:
-            map_id = int(row[1])
-            construct = Construct(
-                type=int(row[2]),
-                pos=pos_dict[int(row[4])],
-                is_display=(row[3] == '1'),
-            )
-            map_construct_dict.setdefault(map_id, []).append(construct)
-            if construct.type // 1000 in POI_CONSTRUCTS:
-                all_poi_pos.add(construct.pos)
-                all_poi_construct_type.add(construct.type)
+            ctype, pos = int(row[2]), pos_dict[int(row[4])]
+            construct_rows.append((int(row[1]), ctype, pos_columns.setdefault(pos, len(pos_columns)), row[3] == '1'))
+            if ctype // 1000 in POI_CONSTRUCTS:
+                all_poi_pos.add(pos)
+                all_poi_construct_type.add(ctype)
         all_poi_construct_type.add(0)
+        construct_rows = np.array(construct_rows, dtype=np.int64).reshape(-1, 4)
 
     with open(map_patterns_csv_path, 'r', encoding='utf-8') as f:
         f.readline()
         reader = csv.reader(f)
-        patterns = []
+        scalar_rows = []
         for row in reader:
-            patterns.append(MapPattern(
-                id=int(row[0]),
-                nightlord=int(row[1]),
-                earth_shifting=int(row[2]),
-                start_pos=pos_dict[int(row[3])],
-                treasure=int(row[4]),
-                event_value=int(row[5]),
-                event_flag=int(row[6]),
-                evpat_value=int(row[7]),
-                evpat_flag=int(row[8]),
-                rot_rew=int(row[9]),
-                day1_boss=int(row[10]),
-                day1_pos=pos_dict[int(row[11])],
-                day2_boss=int(row[12]),
-                day2_pos=pos_dict[int(row[13])],
-                day1_extra_boss=int(row[14]),
-                day2_extra_boss=int(row[15]),
-                pos_constructions={ c.pos: c for c in map_construct_dict.get(int(row[0]), [])}
+            scalar_rows.append((
+                int(row[0]),                    # id
+                int(row[1]),                    # nightlord
+                int(row[2]),                    # earth_shifting
+                pos_dict[int(row[3])],          # start_pos
+                int(row[10]),                   # day1_boss
+                int(row[14]),                   # day1_extra_boss
+                pos_dict[int(row[11])],         # day1_pos
+                int(row[12]),                   # day2_boss
+                int(row[15]),                   # day2_extra_boss
+                pos_dict[int(row[13])],         # day2_pos
+                int(row[4]),                    # treasure
+                int(row[9]),                    # rot_rew
+                int(row[5]),                    # event_value
+                int(row[6]),                    # event_flag
+                int(row[7]),                    # evpat_value
+                int(row[8]),                    # evpat_flag
             ))
-    
-    return MapInfo(
+        scalars = np.array(scalar_rows, dtype=PATTERN_DTYPE)
+
+    # 建筑矩阵：列按位置坐标排序，同一模式同一位置有多个建筑时保留最后一个
+    construct_pos = sorted(pos_columns)
+    column_order = np.empty(len(construct_pos), dtype=np.int64)
+    column_order[[pos_columns[pos] for pos in construct_pos]] = np.arange(len(construct_pos))
+    row_lookup = np.full(max(int(scalars['id'].max(initial=0)), int(construct_rows[:, 0].max(initial=0))) + 1, -1, dtype=np.int64)
+    row_lookup[scalars['id']] = np.arange(len(scalars))
+    rows = row_lookup[construct_rows[:, 0]]
+    valid = rows >= 0
+    rows, columns = rows[valid], column_order[construct_rows[valid, 2]]
+    construct_types = np.full((len(scalars), len(construct_pos)), NO_CONSTRUCT, dtype=np.int32)
+    construct_display = np.zeros((len(scalars), len(construct_pos)), dtype=bool)
+    construct_types[rows, columns] = construct_rows[valid, 1]
+    construct_display[rows, columns] = construct_rows[valid, 3].astype(bool)
+    pattern_table = MapPatternTable(
+        scalars=scalars,
+        construct_pos=np.array(construct_pos, dtype=np.int32).reshape(-1, 2),
+        construct_types=construct_types,
+        construct_display=construct_display,
+    )
+    return _make_map_info(
         name_dict=name_dict,
         pos_dict=pos_dict,
-        patterns=patterns,
+        pattern_table=pattern_table,
         all_poi_pos=all_poi_pos,
         all_poi_construct_type=all_poi_construct_type,
     )
\ No newline at end of file
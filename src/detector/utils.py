@@ -1,3 +1,8 @@
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Hashable
+
 import cv2
 import numpy as np
 from PIL import Image, ImageDraw, ImageFont
@@ -117,12 +122,38 @@ def get_text_size(font: ImageFont.FreeTypeFont, text: str) -> tuple[int, int]:
 
 
 def draw_icon(img: Image.Image, pos: tuple[int, int], icon: Image.Image, size: tuple[int, int] | None = None):
-    if size is None:
-        size = icon.size
-    icon = icon.resize(size, resample=Image.Resampling.BICUBIC)
+    if size is not None and size != icon.size:
+        icon = icon.resize(size, resample=Image.Resampling.BICUBIC)
+    size = icon.size
     img.alpha_composite(icon, (pos[0] - size[0] // 2, pos[1] - size[1] // 2))
 
 
+@dataclass
+class TextSprite:
+    text_size: tuple[int, int]      # 不含描边的文字尺寸，用于对齐
+    offset: tuple[int, int]         # 图像左上角相对文字绘制位置的偏移
+    image: Image.Image
+
+
+def get_text_sprite(text: str, size: int,
+                    color: tuple[int, int, int, int],
+                    outline_width: int = 0,
+                    outline_color: tuple[int, int, int, int] = (0, 0, 0, 255),
+                    path: str = DEFAULT_FONT_PATH) -> TextSprite:
+    """
+    渲染带描边的文字图像并测量文字尺寸，每种 (字体, 文本, 颜色, 描边) 只渲染一次。
+    返回的图像在多处共享，不能原地修改
+    """
+    def render() -> TextSprite:
+        font = get_font(size, path)
+        left, top, right, bottom = font.getbbox(text, stroke_width=outline_width)
+        image = Image.new("RGBA", (max(1, right - left), max(1, bottom - top)), (0, 0, 0, 0))
+        ImageDraw.Draw(image).text((-left, -top), text, font=font, fill=color,
+                                   stroke_width=outline_width, stroke_fill=outline_color)
+        return TextSprite(text_size=get_text_size(font, text), offset=(left, top), image=image)
+    return text_sprite_cache.get_or_create((path, size, text, color, outline_width, outline_color), render)
+
+
 def draw_text(img: Image.Image, pos: tuple[int, int], text: str, size: int,
               color: tuple[int, int, int, int],
               outline_width: int = 0,
@@ -130,41 +161,242 @@ def draw_text(img: Image.Image, pos: tuple[int, int], text: str, size: int,
               align='c'):
     assert align in ('lb', 'c', 'lt')
     if text is None: text = "null"
-    draw = ImageDraw.Draw(img)
-    font = get_font(size)
-    text_size = get_text_size(font, text)
+    text_sprite = get_text_sprite(text, size, tuple(color), outline_width, tuple(outline_color))
+    text_size, sprite = text_sprite.text_size, text_sprite.image
     if align == 'lb':
         pos = (pos[0] + text_size[0] // 2, pos[1] - text_size[1] // 2)
     elif align == 'lt':
         pos = (pos[0] + text_size[0] // 2, pos[1] + text_size[1] // 2)
-    if outline_width > 0:
-        for dx in range(-outline_width, outline_width+1):
-            for dy in range(-outline_width, outline_width+1):
-                if dx*dx + dy*dy <= outline_width * outline_width:
-                    draw.text((pos[0] - text_size[0] // 2 + dx,
-                              pos[1] - text_size[1] // 2 + dy), text,
-                              font=font, fill=outline_color)
-    draw.text((pos[0] - text_size[0] // 2, pos[1] - text_size[1] // 2),
-              text, font=font, fill=color)
-
-
-def match_template(
-    image: np.ndarray, 
-    template: np.ndarray, 
-    scales: tuple[float, float, int], 
-    mask: np.ndarray=None
-) -> tuple[tuple[int, int, int, float] | None, float]:
-    best_match = None
-    best_val = float('inf')
-    for scale in np.linspace(scales[0], scales[1], num=scales[2], endpoint=True):
-        resized_template = cv2.resize(template, (int(template.shape[1] * scale), int(template.shape[0] * scale)))
-        if resized_template.shape[0] > image.shape[0] or resized_template.shape[1] > image.shape[1]:
-            continue
-        if mask is not None:
-            mask = cv2.resize(mask, (resized_template.shape[1], resized_template.shape[0]))
-        result = cv2.matchTemplate(image, resized_template, cv2.TM_SQDIFF_NORMED, mask)
-        min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(result)
-        if min_val < best_val:
-            best_val = min_val
-            best_match = (min_loc, resized_template.shape[1], resized_template.shape[0], scale)
-    return best_match, best_val
\ No newline at end of file
+    x = pos[0] - text_size[0] // 2 + text_sprite.offset[0]
+    y = pos[1] - text_size[1] // 2 + text_sprite.offset[1]
+    # alpha_composite 不支持负坐标，裁掉超出左上边界的部分
+    if x < 0 or y < 0:
+        if x <= -sprite.width or y <= -sprite.height:
+            return
+        sprite = sprite.crop((max(0, -x), max(0, -y), sprite.width, sprite.height))
+        x, y = max(0, x), max(0, y)
+    img.alpha_composite(sprite, (x, y))
+
+
+_MISSING = object()
+
+
+class LRUCache:
+    """
+    线程安全的LRU缓存，可按条目数量和/或占用字节数限制容量
+    """
+    def __init__(self, max_items: int | None = None, max_bytes: int | None = None,
+                 sizeof: Callable[[Any], int] | None = None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or (lambda v: 0)
+        self.total_bytes = 0
+        self._data: OrderedDict[Hashable, Any] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._data
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key: Hashable, value: Any):
+        with self._lock:
+            if key in self._data:
+                self.total_bytes -= self.sizeof(self._data.pop(key))
+            self._data[key] = value
+            self.total_bytes += self.sizeof(value)
+            while len(self._data) > 1 and (
+                (self.max_items is not None and len(self._data) > self.max_items) or
+                (self.max_bytes is not None and self.total_bytes > self.max_bytes)
+            ):
+                _, evicted = self._data.popitem(last=False)
+                self.total_bytes -= self.sizeof(evicted)
+
+    def get_or_create(self, key: Hashable, factory: Callable[[], Any]) -> Any:
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = factory()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.total_bytes = 0
+
+
+# 渲染好的文字图像，地图信息中的名称在各候选地图间大量重复
+TEXT_SPRITE_CACHE_MAX_BYTES = 16 * 1024 * 1024
+text_sprite_cache = LRUCache(max_bytes=TEXT_SPRITE_CACHE_MAX_BYTES,
+                             sizeof=lambda sprite: sprite.image.width * sprite.image.height * 4)
+
+
+@dataclass
+class TemplateMatch:
+    template_id: Hashable
+    score: float                # TM_SQDIFF_NORMED 得分，越低越好
+    loc: tuple[int, int]        # 匹配位置左上角 (x, y)
+    size: tuple[int, int]       # 缩放后模板尺寸 (w, h)
+    scale: float
+
+
+TemplateSearchStrategy = Callable[['TemplateBank', np.ndarray, list[Hashable], np.ndarray], dict[Hashable, TemplateMatch]]
+
+TEMPLATE_SEARCH_STRATEGIES: dict[str, TemplateSearchStrategy] = {}
+
+def register_template_search_strategy(name: str):
+    def decorator(func: TemplateSearchStrategy) -> TemplateSearchStrategy:
+        TEMPLATE_SEARCH_STRATEGIES[name] = func
+        return func
+    return decorator
+
+
+class TemplateBank:
+    """
+    多尺度模板库：缓存每个模板在每个缩放比例下的模板和掩码，
+    掩码总是从原始掩码缩放，避免多次插值累积误差
+    """
+    def __init__(self, strategy: str = 'scan', max_cached: int = 256):
+        assert strategy in TEMPLATE_SEARCH_STRATEGIES, f"unknown template search strategy: {strategy}"
+        self.strategy = strategy
+        self.templates: dict[Hashable, tuple[np.ndarray, np.ndarray | None]] = {}
+        self.cache = LRUCache(max_items=max_cached)
+
+    def add(self, template_id: Hashable, template: np.ndarray, mask: np.ndarray | None = None):
+        self.templates[template_id] = (template, mask)
+
+    def get_scaled(self, template_id: Hashable, scale: float) -> tuple[np.ndarray, np.ndarray | None]:
+        def create():
+            template, mask = self.templates[template_id]
+            size = (int(template.shape[1] * scale), int(template.shape[0] * scale))
+            if size[0] <= 0 or size[1] <= 0:
+                return None, None
+            resized_template = cv2.resize(template, size)
+            resized_mask = cv2.resize(mask, size) if mask is not None else None
+            return resized_template, resized_mask
+        return self.cache.get_or_create(('template', template_id, float(scale)), create)
+
+    def match_all(
+        self,
+        image: np.ndarray,
+        scales: tuple[float, float, int],
+        template_ids: list[Hashable] | None = None,
+        strategy: str | None = None,
+    ) -> dict[Hashable, TemplateMatch]:
+        """
+        返回每个模板在所有缩放比例下的最佳匹配，无法匹配（模板大于图像）的模板不出现在结果中
+        """
+        if template_ids is None:
+            template_ids = list(self.templates.keys())
+        scale_list = np.linspace(scales[0], scales[1], num=scales[2], endpoint=True)
+        search = TEMPLATE_SEARCH_STRATEGIES[strategy or self.strategy]
+        return search(self, image, template_ids, scale_list)
+
+    def best_match(
+        self,
+        image: np.ndarray,
+        scales: tuple[float, float, int],
+        template_ids: list[Hashable] | None = None,
+        strategy: str | None = None,
+    ) -> TemplateMatch | None:
+        matches = self.match_all(image, scales, template_ids, strategy)
+        return min(matches.values(), key=lambda m: m.score, default=None)
+
+
+def _update_best_match(matches: dict[Hashable, TemplateMatch], match: TemplateMatch):
+    if match.template_id not in matches or match.score < matches[match.template_id].score:
+        matches[match.template_id] = match
+
+
+@register_template_search_strategy('scan')
+def _scan_template_search(bank: TemplateBank, image: np.ndarray, template_ids: list[Hashable],
+                          scales: np.ndarray) -> dict[Hashable, TemplateMatch]:
+    """
+    逐个模板逐个缩放比例调用 cv2.matchTemplate，支持掩码
+    """
+    matches: dict[Hashable, TemplateMatch] = {}
+    for template_id in template_ids:
+        for scale in scales:
+            template, mask = bank.get_scaled(template_id, scale)
+            if template is None or template.shape[0] > image.shape[0] or template.shape[1] > image.shape[1]:
+                continue
+            result = cv2.matchTemplate(image, template, cv2.TM_SQDIFF_NORMED, mask=mask)
+            min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(result)
+            _update_best_match(matches, TemplateMatch(
+                template_id, float(min_val), min_loc, (template.shape[1], template.shape[0]), float(scale)))
+    return matches
+
+
+@register_template_search_strategy('fft')
+def _fft_template_search(bank: TemplateBank, image: np.ndarray, template_ids: list[Hashable],
+                         scales: np.ndarray) -> dict[Hashable, TemplateMatch]:
+    """
+    将所有 (模板, 缩放比例) 补零到图像尺寸后按批计算FFT互相关，模板的频谱按图像尺寸缓存。
+    截图只做一次FFT，频谱乘积是一次批量矩阵乘法，逆FFT一次批量完成，得分按模板尺寸分组向量化计算。
+    每个 (模板, 缩放比例) 仍需一次逆FFT，代价随模板数量线性增长。不支持掩码
+    """
+    image = image.astype(np.float64)
+    if image.ndim == 2:
+        image = image[..., None]
+    img_h, img_w, channels = image.shape
+
+    entries = []
+    for template_id in template_ids:
+        assert bank.templates[template_id][1] is None, "fft template search does not support mask"
+        for scale in scales:
+            template, _ = bank.get_scaled(template_id, scale)
+            if template is None or template.shape[0] > img_h or template.shape[1] > img_w:
+                continue
+            entries.append((template_id, float(scale), template))
+    if not entries:
+        return {}
+
+    def create_atlas_spectrum():
+        atlas = np.zeros((len(entries), img_h, img_w, channels), dtype=np.float64)
+        sqsums = np.zeros(len(entries), dtype=np.float64)
+        for i, (_, _, template) in enumerate(entries):
+            template = template.astype(np.float64).reshape(template.shape[0], template.shape[1], channels)
+            atlas[i, :template.shape[0], :template.shape[1]] = template
+            sqsums[i] = np.sum(template ** 2)
+        # 按 (频率, 模板, 通道) 存放，与截图频谱的乘积和通道求和是一次批量矩阵乘法
+        spectrum = np.conj(np.fft.rfft2(atlas, axes=(1, 2))).reshape(len(entries), -1, channels)
+        spectrum = np.ascontiguousarray(spectrum.transpose(1, 0, 2))
+        # 相同尺寸的模板共用截图的平方和窗口，一起计算得分
+        groups: dict[tuple[int, int], list[int]] = {}
+        for i, (_, _, template) in enumerate(entries):
+            groups.setdefault(template.shape[:2], []).append(i)
+        return spectrum, sqsums, [(size, np.array(indices)) for size, indices in groups.items()]
+    key = ('fft_atlas', (img_h, img_w, channels), tuple((e[0], e[1]) for e in entries))
+    atlas_spectrum, template_sqsums, size_groups = bank.cache.get_or_create(key, create_atlas_spectrum)
+
+    spectrum = np.fft.rfft2(image, axes=(0, 1)).reshape(-1, channels, 1)
+    product = np.matmul(atlas_spectrum, spectrum)[..., 0].T.reshape(len(entries), img_h, -1)
+    ccorr = np.fft.irfft2(product, s=(img_h, img_w), axes=(1, 2))
+    image_sq_integral = cv2.integral(np.sum(image ** 2, axis=2))
+
+    matches: dict[Hashable, TemplateMatch] = {}
+    for (h, w), indices in size_groups:
+        out_w = img_w - w + 1
+        cross = ccorr[indices, :img_h - h + 1, :out_w]
+        image_sq = image_sq_integral[h:, w:] - image_sq_integral[:-h, w:] \
+            - image_sq_integral[h:, :-w] + image_sq_integral[:-h, :-w]
+        template_sq = template_sqsums[indices, None, None]
+        # 与 cv2.TM_SQDIFF_NORMED 一致：分母过小时得分记为1
+        num = image_sq - 2 * cross + template_sq
+        denom = np.sqrt(np.maximum(image_sq, 0) * template_sq)
+        score = np.where(np.abs(num) < denom, num / np.maximum(denom, 1e-12), 1.0).reshape(len(indices), -1)
+        best = score.argmin(axis=1)
+        for k, (i, b) in enumerate(zip(indices.tolist(), best.tolist())):
+            template_id, scale, _ = entries[i]
+            y, x = divmod(b, out_w)
+            _update_best_match(matches, TemplateMatch(template_id, float(score[k, b]), (x, y), (w, h), scale))
+    return matches
@@ -0,0 +1,70 @@
+import threading
+import traceback
+from typing import Any, Callable
+
+from src.logger import error
+
+
+class LatestJobQueue:
+    """
+    在一个后台线程中逐个执行任务，只保留最新提交的任务。
+    新提交的任务或取消操作使之前的任务过期：尚未开始的任务被丢弃，正在执行的任务需要通过 is_current 检查后自行中止
+    """
+    def __init__(self, name: str, run_job: Callable[[int, Any], None]):
+        """
+        run_job(generation, job) 在后台线程中执行，generation 为任务编号
+        """
+        self.name = name
+        self.run_job = run_job
+        self._cond = threading.Condition()
+        self._generation = 0
+        self._pending: tuple[int, Any] | None = None
+        self._running = False
+        self._thread: threading.Thread | None = None
+
+    def _ensure_started(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def submit(self, job: Any) -> int:
+        """
+        提交任务，取代尚未完成的任务，返回任务编号
+        """
+        with self._cond:
+            self._generation += 1
+            self._pending = (self._generation, job)
+            self._ensure_started()
+            self._cond.notify()
+            return self._generation
+
+    def cancel(self):
+        with self._cond:
+            self._generation += 1
+            self._pending = None
+
+    def is_current(self, generation: int) -> bool:
+        with self._cond:
+            return generation == self._generation
+
+    def is_busy(self) -> bool:
+        """
+        是否有正在执行或等待执行的任务
+        """
+        with self._cond:
+            return self._running or self._pending is not None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._pending is None:
+                    self._cond.wait()
+                (generation, job), self._pending = self._pending, None
+                self._running = True
+            try:
+                self.run_job(generation, job)
+            except Exception:
+                error(f"{self.name} job #{generation} error:\n" + traceback.format_exc())
+            finally:
+                with self._cond:
+                    self._running = False
@@ -0,0 +1,120 @@
+import traceback
+from dataclasses import dataclass
+
+import numpy as np
+from PyQt6.QtCore import QObject, pyqtSignal
+
+from src.detector import DetectParam, DetectorManager, MapDetectParam, MapDetectResult, MapEvidence, MapMatchCancelled
+from src.latest_job_queue import LatestJobQueue
+from src.logger import error, info
+
+
+@dataclass
+class MapMatchJob:
+    map_region: tuple[int]
+    img: np.ndarray
+    evidence: MapEvidence | None = None  # 之前帧累积的证据，不为None时跳过特殊地形识别
+    bypass_pattern_cache: bool = False  # 重新识别时不使用模式匹配缓存
+
+
+@dataclass
+class MapMatchProgress:
+    generation: int
+    stage: str          # earth_shifting / pattern / overlay
+    progress: float     # 0~1
+
+
+@dataclass
+class MapMatchJobResult:
+    generation: int
+    earth_shifting: int | None = None
+    map_detect_result: MapDetectResult | None = None  # 特殊地形识别失败时为None
+
+
+class MapMatchWorker(QObject):
+    """
+    在后台线程中进行地图识别（特殊地形识别、模式匹配和信息绘制），避免阻塞主循环。
+    同一时间只执行一个任务，新提交的任务或取消操作会使正在执行的任务在下一个检查点中止，
+    进度和结果通过信号发出，只发出最新任务的结果
+    """
+    progress_signal = pyqtSignal(MapMatchProgress)
+    finished_signal = pyqtSignal(MapMatchJobResult)
+
+    def __init__(self, detector: DetectorManager):
+        super().__init__()
+        self.detector = detector
+        self._jobs = LatestJobQueue("MapMatchWorker", self._run_and_emit)
+
+    def submit(self, map_region: tuple[int], img: np.ndarray, evidence: MapEvidence | None = None,
+               bypass_pattern_cache: bool = False) -> int:
+        """
+        提交识别任务，取代尚未完成的任务，返回任务编号
+        """
+        return self._jobs.submit(MapMatchJob(map_region=map_region, img=img, evidence=evidence,
+                                             bypass_pattern_cache=bypass_pattern_cache))
+
+    def cancel(self):
+        self._jobs.cancel()
+
+    def is_current(self, generation: int) -> bool:
+        return self._jobs.is_current(generation)
+
+    def is_busy(self) -> bool:
+        """
+        是否有正在执行或等待执行的任务
+        """
+        return self._jobs.is_busy()
+
+    def _run_and_emit(self, generation: int, job: MapMatchJob):
+        try:
+            result = self._run_job(generation, job)
+            if self.is_current(generation):
+                self.finished_signal.emit(result)
+        except MapMatchCancelled:
+            info(f"Map match job #{generation} cancelled.")
+        except Exception:
+            error(f"Map match job #{generation} error:\n" + traceback.format_exc())
+            if self.is_current(generation):
+                self.finished_signal.emit(MapMatchJobResult(generation=generation))
+
+    def _run_job(self, generation: int, job: MapMatchJob) -> MapMatchJobResult:
+        def is_cancelled() -> bool:
+            return not self.is_current(generation)
+
+        def on_progress(stage: str, progress: float):
+            self.progress_signal.emit(MapMatchProgress(generation=generation, stage=stage, progress=progress))
+
+        if job.evidence is not None:
+            earth_shifting = job.evidence.earth_shifting
+        else:
+            result = self.detector.detect(DetectParam(
+                map_detect_param=MapDetectParam(
+                    map_region=job.map_region,
+                    img=job.img,
+                    do_match_earth_shifting=True,
+                    is_cancelled=is_cancelled,
+                    on_progress=on_progress,
+                )
+            ))
+            earth_shifting = result.map_detect_result.earth_shifting
+            if earth_shifting is None:
+                return MapMatchJobResult(generation=generation)
+
+        result = self.detector.detect(DetectParam(
+            map_detect_param=MapDetectParam(
+                map_region=job.map_region,
+                img=job.img,
+                earth_shifting=earth_shifting,
+                do_match_pattern=True,
+                accumulate_evidence=True,
+                evidence=job.evidence,
+                bypass_pattern_cache=job.bypass_pattern_cache,
+                is_cancelled=is_cancelled,
+                on_progress=on_progress,
+            )
+        ))
+        return MapMatchJobResult(
+            generation=generation,
+            earth_shifting=earth_shifting,
+            map_detect_result=result.map_detect_result,
+        )
@@ -0,0 +1,53 @@
+import time
+from dataclasses import dataclass
+from typing import Callable
+
+from src.detector import DetectorManager
+from src.detector.map_info import MapPattern
+from src.latest_job_queue import LatestJobQueue
+from src.logger import info
+
+# 地图识别进行时暂停预绘制，每隔此时间检查一次
+PRERENDER_BUSY_POLL_INTERVAL = 0.1
+# 每绘制一张后让出的时间，避免长时间占用GIL拖慢主循环和界面
+PRERENDER_YIELD_INTERVAL = 0.02
+
+
+@dataclass
+class MapOverlayPrerenderJob:
+    patterns: list[MapPattern]     # 按可能显示的先后排列
+    draw_size: tuple[int, int]
+
+
+class MapOverlayPrerenderer:
+    """
+    在后台预先绘制之后可能显示的地图信息图像，结果保存在地图识别器的信息图像缓存中。
+    新的请求取代尚未完成的请求；每绘制一张检查一次，地图识别进行时暂停，避免与识别争抢CPU
+    """
+    def __init__(self, detector: DetectorManager, is_busy: Callable[[], bool]):
+        self.detector = detector
+        self.is_busy = is_busy
+        self._jobs = LatestJobQueue("MapOverlayPrerenderer", self._run_job)
+
+    def request(self, patterns: list[MapPattern], draw_size: tuple[int, int]):
+        self._jobs.submit(MapOverlayPrerenderJob(patterns=patterns, draw_size=draw_size))
+
+    def cancel(self):
+        self._jobs.cancel()
+
+    def _run_job(self, generation: int, job: MapOverlayPrerenderJob):
+        t = time.time()
+        map_detector = self.detector.map_detector
+        rendered = 0
+        for pattern in job.patterns:
+            while self.is_busy() and self._jobs.is_current(generation):
+                time.sleep(PRERENDER_BUSY_POLL_INTERVAL)
+            if not self._jobs.is_current(generation):
+                info(f"Map overlay prerender #{generation} superseded after {rendered} overlays.")
+                return
+            if not map_detector.has_overlay_image(pattern, job.draw_size):
+                map_detector.get_overlay_image(pattern, job.draw_size)
+                rendered += 1
+                time.sleep(PRERENDER_YIELD_INTERVAL)
+        info(f"Map overlay prerender #{generation}: rendered {rendered}/{len(job.patterns)} overlays "
+             f"size: {job.draw_size}, time cost: {time.time() - t:.4f}s")
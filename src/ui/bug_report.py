@@ -135,7 +135,9 @@ class BugReportWindow(QMainWindow):
                 zip_filepath, "w", zipfile.ZIP_DEFLATED
             ) as zipf:
                 # 1. 添加日志目录
-                for root, _, files in os.walk(self.log_directory):
+                for root, dirs, files in os.walk(self.log_directory):
+                    # 跳过体积较大且可重新生成的预计算缓存
+                    dirs[:] = [d for d in dirs if d != "cache"]
                     for file in files:
                         file_path = os.path.join(root, file)
                         arcname = os.path.relpath(file_path, self.log_directory)
@@ -1,14 +1,18 @@
+import queue
 import time
 from enum import Enum
 
 from PIL import Image
-from PyQt6.QtCore import QObject, pyqtSignal
+from PyQt6.QtCore import QObject, Qt, pyqtSignal
 
 from src.common import GAME_WINDOW_TITLE
 from src.config import Config
-from src.detector import (ArtDetectParam, DayDetectParam, DetectParam, DetectorManager, HpDetectParam, MapDetectParam, RainDetectParam)
+from src.detector import (ArtDetectParam, DayDetectParam, DetectParam, DetectorManager, HpDetectParam, MapDetectParam, MapEvidence, RainDetectParam)
+from src.detector.map_detector import MapDetectResult, PatternMatch
 from src.detector.map_info import MapPattern
 from src.logger import error, info
+from src.map_match_worker import MapMatchJobResult, MapMatchProgress, MapMatchWorker
+from src.map_overlay_prerenderer import MapOverlayPrerenderer
 from src.ui.hp_overlay import HpOverlayUIState, HpOverlayWidget
 from src.ui.input import InputWorker
 from src.ui.map_overlay import MapOverlayUIState, MapOverlayWidget
@@ -20,6 +24,7 @@ class DoMatchMapPatternFlag(Enum):
     FALSE = 0
     PREPARE = 1
     TRUE = 2
+    MATCHING = 3
 
 
 class Phase(Enum):
@@ -78,15 +83,35 @@ class Updater(QObject):
 
         self.map_overlay = map_overlay
         self.update_map_overlay_ui_state_signal.connect(self.map_overlay.update_ui_state)
-        self.map_detect_enabled: bool = True
+        self._map_detect_enabled: bool = True
         self.map_region: tuple[int] = None
         self.do_match_map_pattern_flag: DoMatchMapPatternFlag = DoMatchMapPatternFlag.TRUE
         self.map_pattern: MapPattern = None
         self.last_map_pattern_match_time: float = 0.0
 
+        # 后台地图识别，主循环阻塞了该线程的事件循环，因此信号直接在工作线程中放入队列，由主循环处理
+        self.map_match_worker = MapMatchWorker(self.detector)
+        self.map_match_updates: queue.Queue[MapMatchProgress | MapMatchJobResult] = queue.Queue()
+        self.map_match_worker.progress_signal.connect(self.map_match_updates.put, Qt.ConnectionType.DirectConnection)
+        self.map_match_worker.finished_signal.connect(self.map_match_updates.put, Qt.ConnectionType.DirectConnection)
+        self.map_match_generation: int | None = None
+        self.map_match_progress: MapMatchProgress | None = None
+        # 尚未确定结果时累积的多帧识别证据，下一帧完整地图继续识别
+        self.map_evidence: MapEvidence | None = None
+        # 最近一次自动识别的候选模式（按置信度排序）
+        self.map_pattern_ranked: list[PatternMatch] = []
+        # 后台预先绘制之后可能显示的信息图像，地图识别进行时暂停
+        self.map_overlay_prerenderer = MapOverlayPrerenderer(self.detector, is_busy=self.map_match_worker.is_busy)
+        # 识别结果置信度较低时重新识别的时间和已重新识别的次数
+        self.map_pattern_rematch_time: float | None = None
+        self.map_pattern_rematches: int = 0
+        # 正在重新识别：不使用模式匹配缓存，识别完成前保留当前显示的信息
+        self.map_pattern_rematching: bool = False
+
         # 手动选择模式的候选地图管理
-        self.manual_mode_candidates: list[tuple[MapPattern, Image.Image]] = []  # 候选地图列表 [(pattern, overlay_image), ...]
+        self.manual_mode_candidates: list[MapPattern] = []  # 候选地图列表，信息图像在切换到该候选时才绘制
         self.manual_mode_current_index: int = 0  # 当前显示的候选索引
+        self.manual_mode_draw_size: tuple[int, int] | None = None  # 候选地图信息图像的绘制大小
 
         self.hp_overlay = hp_overlay
         self.hp_overlay_ui_state_signal.connect(self.hp_overlay.update_ui_state)
@@ -100,6 +125,17 @@ class Updater(QObject):
         self.art_region: tuple[int] = None
         self.art_type: str = None
 
+    @property
+    def map_detect_enabled(self) -> bool:
+        return self._map_detect_enabled
+
+    @map_detect_enabled.setter
+    def map_detect_enabled(self, enabled: bool):
+        # 关闭地图识别时取消后台识别，之后到达的结果不再应用
+        if not enabled:
+            self.cancel_map_match()
+        self._map_detect_enabled = enabled
+
     @property
     def current_map_overlay_visible(self) -> bool:
         return self.map_overlay.target_opacity > 0
@@ -253,13 +289,38 @@ class Updater(QObject):
 
     # =============== Map Pattern Management =============== #
 
-    def set_to_detect_map_pattern_once(self):
+    def set_to_detect_map_pattern_once(self, is_rematch: bool = False):
+        self.cancel_map_match()
+        self.map_evidence = None
+        self.map_pattern_rematch_time = None
+        if not is_rematch:
+            self.map_pattern_rematches = 0
+        self.map_pattern_rematching = is_rematch
         self.do_match_map_pattern_flag = DoMatchMapPatternFlag.PREPARE
         info("Set to detect map pattern once.")
 
+    def cancel_map_match(self):
+        if self.map_match_generation is not None:
+            self.map_match_worker.cancel()
+            info(f"Cancel map match job #{self.map_match_generation}.")
+            self.map_match_generation = None
+            self.map_match_progress = None
+            if self.do_match_map_pattern_flag == DoMatchMapPatternFlag.MATCHING:
+                self.do_match_map_pattern_flag = DoMatchMapPatternFlag.TRUE
+
     def update_overlay_match_map_pattern_text(self):
         match_ready = self.do_match_map_pattern_flag != DoMatchMapPatternFlag.FALSE and self.map_detect_enabled
-        if match_ready:
+        progress = self.map_match_progress
+        if self.do_match_map_pattern_flag == DoMatchMapPatternFlag.MATCHING and progress is not None \
+                and progress.stage != "earth_shifting":
+            self.update_overlay_ui_state_signal.emit(OverlayUIState(
+                map_pattern_match_text=f" - 地图识别中 {int(progress.progress * 100)}%",
+            ))
+        elif match_ready and self.map_evidence is not None:
+            self.update_overlay_ui_state_signal.emit(OverlayUIState(
+                map_pattern_match_text=f" - 地图识别中 (第{self.map_evidence.frames}帧)",
+            ))
+        elif match_ready:
             self.update_overlay_ui_state_signal.emit(OverlayUIState(
                 map_pattern_match_text=" - 地图识别就绪",
             ))
@@ -336,49 +397,108 @@ class Updater(QObject):
             self.set_to_detect_map_pattern_once()
             self.last_map_pattern_match_time = self.get_time()
             info("Set to detect map pattern once by interval.")
+        elif self.map_pattern_rematch_time is not None and self.get_time() > self.map_pattern_rematch_time and is_full_map:
+            self.set_to_detect_map_pattern_once(is_rematch=True)
+            info(f"Set to rematch low confidence map pattern ({self.map_pattern_rematches}).")
 
         if self.do_match_map_pattern_flag == DoMatchMapPatternFlag.PREPARE:
-            # 隐藏信息显示，等待下一次更新进行识别
+            # 隐藏信息显示，等待下一次更新进行识别（重新识别时保留当前结果直到新结果到达）
             self.do_match_map_pattern_flag = DoMatchMapPatternFlag.TRUE
-            self.update_map_overlay_image(None)
-            info("Hide overlay and prepared to detect map pattern.")
+            if self.map_pattern_rematching:
+                info("Prepared to rematch map pattern.")
+            else:
+                self.update_map_overlay_image(None)
+                info("Hide overlay and prepared to detect map pattern.")
 
         elif self.do_match_map_pattern_flag == DoMatchMapPatternFlag.TRUE and is_full_map:
-            # 特殊地形识别成功才进行匹配（避免地图半透明时就识别）
-            result = self.detector.detect(DetectParam(
-                map_detect_param=MapDetectParam(
-                    map_region=self.map_region,
-                    img=map_img,  # 使用之前截取的图片，避免处理过程中画面变化
-                    do_match_earth_shifting=True,
-                )
-            ))
-            earth_shifting = result.map_detect_result.earth_shifting
-            if earth_shifting is not None:
-                # 进行匹配
-                self.do_match_map_pattern_flag = DoMatchMapPatternFlag.FALSE
-                self.update_map_overlay_ui_state_signal.emit(MapOverlayUIState(
-                    clear_image=True,
-                    map_pattern_matching=True,
-                    x=self.map_region[0],
-                    y=self.map_region[1],
-                    w=self.map_region[2],
-                    h=self.map_region[3],
-                    opacity=1.0,
-                ))
-                self.update_overlay_ui_state_signal.emit(OverlayUIState(
-                    map_pattern_match_text="",
-                ))
-                result = self.detector.detect(DetectParam(
-                    map_detect_param=MapDetectParam(
-                        map_region=self.map_region,
-                        img=map_img,
-                        earth_shifting=earth_shifting,
-                        do_match_pattern=True,
-                    )
-                ))
-                self.map_pattern = result.map_detect_result.pattern
-                self.update_map_overlay_image(result.map_detect_result.overlay_image)
-                self.last_map_pattern_match_time = self.get_time()
+            # 在后台识别，使用之前截取的图片，避免处理过程中画面变化
+            self.do_match_map_pattern_flag = DoMatchMapPatternFlag.MATCHING
+            self.map_match_progress = None
+            self.map_match_generation = self.map_match_worker.submit(
+                self.map_region, map_img, self.map_evidence, bypass_pattern_cache=self.map_pattern_rematching)
+            info(f"Submit map match job #{self.map_match_generation}.")
+
+    def handle_map_match_updates(self):
+        """
+        处理后台地图识别发出的进度和结果
+        """
+        while True:
+            try:
+                update = self.map_match_updates.get_nowait()
+            except queue.Empty:
+                break
+            if update.generation != self.map_match_generation:
+                continue
+            if not self.map_detect_enabled or self.do_match_map_pattern_flag != DoMatchMapPatternFlag.MATCHING:
+                # 识别已关闭或已切换到手动选择，丢弃过期的进度和结果
+                info(f"Discard stale map match update #{update.generation}.")
+                self.cancel_map_match()
+                continue
+
+            if isinstance(update, MapMatchProgress):
+                if update.stage == "pattern" and self.map_evidence is None and not self.map_pattern_rematching \
+                        and (self.map_match_progress is None or self.map_match_progress.stage == "earth_shifting"):
+                    # 特殊地形识别成功后开始匹配，显示识别中状态
+                    self.update_map_overlay_ui_state_signal.emit(MapOverlayUIState(
+                        clear_image=True,
+                        map_pattern_matching=True,
+                        x=self.map_region[0],
+                        y=self.map_region[1],
+                        w=self.map_region[2],
+                        h=self.map_region[3],
+                        opacity=1.0,
+                    ))
+                self.map_match_progress = update
+                continue
+
+            self.map_match_generation = None
+            self.map_match_progress = None
+            if update.map_detect_result is None:
+                # 特殊地形识别失败（避免地图半透明时就识别），下次更新时重试
+                self.do_match_map_pattern_flag = DoMatchMapPatternFlag.TRUE
+                continue
+            if not update.map_detect_result.pattern_decided:
+                # 置信度不足，保留证据等待下一帧完整地图
+                self.map_evidence = update.map_detect_result.evidence
+                self.do_match_map_pattern_flag = DoMatchMapPatternFlag.TRUE
+                info(f"Map pattern undecided after {self.map_evidence.frames} frames, "
+                     f"confidence: {update.map_detect_result.pattern_confidence:.4f}")
+                continue
+            self.map_evidence = None
+            self.map_pattern_rematching = False
+            self.do_match_map_pattern_flag = DoMatchMapPatternFlag.FALSE
+            result = update.map_detect_result
+            self.map_pattern = result.pattern
+            self.update_map_overlay_image(result.overlay_image)
+            self.last_map_pattern_match_time = self.get_time()
+
+            # 保留候选列表用于手动选择，并在后台预先绘制可能切换到的候选
+            self.map_pattern_ranked = result.ranked_patterns or []
+            self.prerender_likely_map_overlays(result)
+
+            # 置信度较低时稍后重新识别
+            config = Config.get()
+            if result.pattern_confidence is not None and result.pattern_confidence < config.map_pattern_rematch_confidence \
+                    and self.map_pattern_rematches < config.map_pattern_max_rematches:
+                self.map_pattern_rematches += 1
+                self.map_pattern_rematch_time = self.get_time() + config.map_pattern_rematch_delay
+                info(f"Map pattern #{result.pattern.id} confidence {result.pattern_confidence:.4f} is low, "
+                     f"rematch in {config.map_pattern_rematch_delay}s.")
+
+    def prerender_likely_map_overlays(self, result: MapDetectResult):
+        """
+        预先绘制前k个候选中置信度较高的其他候选，以及手动选择同一夜王和地形时首先显示的候选及其前后相邻的候选
+        """
+        if result.pattern is None:
+            return
+        map_detector = self.detector.map_detector
+        min_confidence = Config.get().map_pattern_alternate_min_confidence
+        patterns = [match.pattern for match in self.map_pattern_ranked[1:] if match.confidence >= min_confidence]
+        candidates = map_detector.match_map_pattern_all_candidates(
+            result.pattern.nightlord, result.pattern.earth_shifting, self.map_pattern_ranked)
+        patterns += [candidates[i] for i in (0, 1, -1) if -len(candidates) <= i < len(candidates)]
+        patterns = list({pattern.id: pattern for pattern in patterns}.values())
+        self.map_overlay_prerenderer.request(patterns, map_detector.get_overlay_draw_size(self.map_region))
 
     def manual_select_and_update_map(self, nightlord: int, earth_shifting: int):
         """手动模式下根据选择的夜王和地形匹配地图
@@ -388,40 +508,31 @@ class Updater(QObject):
             earth_shifting: 地形ID (0:默认, 1:雪山, 2:火山, 3:腐败森林, 5:隐城)
         """
         try:
+            self.cancel_map_match()
+            self.map_evidence = None
+            self.map_pattern_rematch_time = None
+            self.map_pattern_rematching = False
             original_map_detect_enabled = self.map_detect_enabled
             self.map_detect_enabled = False
 
             # 进行匹配
             self.do_match_map_pattern_flag = DoMatchMapPatternFlag.FALSE
 
-            # 获取所有候选地图
-            config = Config.get()
-            candidates = self.detector.map_detector.match_map_pattern_all_candidates(nightlord, earth_shifting)
+            # 获取所有候选地图，按之前自动识别的置信度排序
+            candidates = self.detector.map_detector.match_map_pattern_all_candidates(nightlord, earth_shifting, self.map_pattern_ranked)
 
             # 计算绘制大小
-            if config.fixed_map_overlay_draw_size is not None:
-                draw_size = tuple(config.fixed_map_overlay_draw_size)
-            elif config.map_overlay_draw_size_ratio is not None:
-                draw_size = (
-                    int(self.map_region[2] * config.map_overlay_draw_size_ratio),
-                    int(self.map_region[3] * config.map_overlay_draw_size_ratio),
-                )
-            else:
-                from src.detector.map_detector import STD_MAP_SIZE
-                draw_size = STD_MAP_SIZE
+            self.manual_mode_draw_size = self.detector.map_detector.get_overlay_draw_size(self.map_region)
 
-            # 为每个候选生成 overlay_image 并保存
-            self.manual_mode_candidates = []
-            for pattern in candidates:
-                overlay_image = self.detector.map_detector.draw_overlay_image(pattern, draw_size)
-                self.manual_mode_candidates.append((pattern, overlay_image))
+            # 只保存候选模式，信息图像在显示时绘制
+            self.map_overlay_prerenderer.cancel()
+            self.manual_mode_candidates = candidates
 
             # 重置索引并显示第一个候选
             if self.manual_mode_candidates:
                 self.manual_mode_current_index = 0
-                first_pattern, first_overlay = self.manual_mode_candidates[0]
-                self.map_pattern = first_pattern
-                self.update_map_overlay_image(first_overlay)
+                self.map_pattern = self.manual_mode_candidates[0]
+                self.update_map_overlay_image(self._get_manual_mode_overlay_image(0))
                 self.show_map_overlay()
                 self.last_map_pattern_match_time = self.get_time()
 
@@ -438,6 +549,17 @@ class Updater(QObject):
             import traceback
             error("Manual detect and update map error:\n" + traceback.format_exc())
 
+    def _get_manual_mode_overlay_image(self, index: int) -> Image.Image:
+        """
+        获取候选地图的信息图像（已绘制过的直接使用），并在后台预先绘制前后相邻的候选
+        """
+        map_detector = self.detector.map_detector
+        overlay_image = map_detector.get_overlay_image(self.manual_mode_candidates[index], self.manual_mode_draw_size)
+        total = len(self.manual_mode_candidates)
+        neighbours = [self.manual_mode_candidates[(index + delta) % total] for delta in (1, -1)]
+        self.map_overlay_prerenderer.request(list({p.id: p for p in neighbours}.values()), self.manual_mode_draw_size)
+        return overlay_image
+
     def _switch_map_candidate(self, delta: int):
         """切换候选地图的通用方法
 
@@ -450,11 +572,11 @@ class Updater(QObject):
 
         # 循环切换索引
         self.manual_mode_current_index = (self.manual_mode_current_index + delta) % len(self.manual_mode_candidates)
-        pattern, overlay_image = self.manual_mode_candidates[self.manual_mode_current_index]
+        pattern = self.manual_mode_candidates[self.manual_mode_current_index]
 
         # 更新显示
         self.map_pattern = pattern
-        self.update_map_overlay_image(overlay_image)
+        self.update_map_overlay_image(self._get_manual_mode_overlay_image(self.manual_mode_current_index))
         self.last_map_pattern_match_time = self.get_time()
 
         # 更新提示文本
@@ -593,6 +715,8 @@ class Updater(QObject):
 
                 is_game_foreground = self.check_game_foreground()
 
+                self.handle_map_match_updates()
+
                 if self.get_time() - last_detect_time > self.detect_interval:
                     if not self.only_detect_when_game_foreground or is_game_foreground:
                         self.detect_and_update_all()
@@ -0,0 +1,7 @@
+import os
+import tempfile
+
+# 测试使用临时的应用数据目录，不读写用户的资源缓存、日志和调试文件。
+# 日志和调试文件目录在导入 src 中的模块时确定，因此在导入测试模块之前设置
+_appdata = tempfile.TemporaryDirectory(prefix="nightreign-test-", ignore_cleanup_errors=True)
+os.environ["APPDATA"] = _appdata.name
@@ -0,0 +1,90 @@
+import cv2
+import numpy as np
+from PIL import Image
+
+from src.detector.map_assets import CV2_RESIZE_METHOD, MAP_ASSETS, MAP_BG_IDS, map_bg_path
+from src.detector.map_detector import MapDetector, STD_POI_SIZE
+from src.detector.map_info import MapPattern, STD_MAP_SIZE
+
+
+def synthesize_map(detector: MapDetector, pattern: MapPattern, shift: tuple[float, float] = (0, 0),
+                   scale: float = 1.0, noise: float = 4.0, occluded: float = 0.0, seed: int = 0,
+                   capture_size: tuple[int, int] = (1000, 1000)) -> np.ndarray:
+    """
+    用地形背景和POI图标合成该地图模式的截图：标准尺寸下截图坐标 = scale * 地图坐标 + shift，
+    随机遮挡 occluded 比例的POI位置，加上噪声后缩放到 capture_size
+    """
+    rng = np.random.default_rng(seed)
+    bg = cv2.resize(MAP_ASSETS.cv2_image(map_bg_path(pattern.earth_shifting)), STD_MAP_SIZE, interpolation=CV2_RESIZE_METHOD)
+    img = Image.fromarray(bg).convert("RGBA")
+    empty_ctype = detector.all_unique_poi_image_ctype[detector.poi_image_index[0]]
+    for pos in detector.pattern_codes.positions:
+        construct = pattern.pos_constructions.get(pos)
+        index = detector.poi_image_index.get(construct.type) if construct else None
+        ctype = detector.all_unique_poi_image_ctype[index] if index is not None else empty_ctype
+        img.alpha_composite(detector.all_unique_poi_images[ctype],
+                            (pos[0] - STD_POI_SIZE[0] // 2, pos[1] - STD_POI_SIZE[1] // 2))
+    img = np.array(img.convert("RGB")).astype(np.float32)
+    positions = detector.pattern_codes.positions
+    for i in rng.choice(len(positions), size=int(len(positions) * occluded), replace=False):
+        x, y = positions[i]
+        img[y - 20:y + 20, x - 20:x + 20] = rng.integers(20, 60)
+    matrix = np.float32([[scale, 0, shift[0]], [0, scale, shift[1]]])
+    img = cv2.warpAffine(img, matrix, STD_MAP_SIZE, borderMode=cv2.BORDER_REPLICATE)
+    img = np.clip(img + rng.normal(0, noise, img.shape), 0, 255).astype(np.uint8)
+    return cv2.resize(img, capture_size, interpolation=cv2.INTER_AREA)
+
+
+FULL_MAP_CORNER_RATIO = 0.22
+
+
+def _embed_full_map_corner(corner: np.ndarray, capture_size: tuple[int, int]) -> np.ndarray:
+    """
+    把左下角区域的内容放入截图中，与完整地图判断裁剪的区域一致
+    """
+    w, h = capture_size
+    img = np.zeros((h, w, 3), dtype=np.uint8)
+    cw, ch = int(w * FULL_MAP_CORNER_RATIO), int(h * FULL_MAP_CORNER_RATIO)
+    img[h - ch:, :cw] = cv2.resize(corner, (cw, ch), interpolation=cv2.INTER_AREA)
+    return img
+
+
+def synthesize_non_map_frame(kind: str, seed: int = 0, capture_size: tuple[int, int] = (1000, 1000)) -> np.ndarray:
+    """
+    合成左下角不是完整地图的截图，kind 为 terrain（地形背景局部）、blur（模糊噪声）或 shapes（随机色块和线条）
+    """
+    rng = np.random.default_rng(seed)
+    if kind == "terrain":
+        bg = MAP_ASSETS.cv2_image(map_bg_path(int(rng.choice(MAP_BG_IDS))))
+        size = int(rng.integers(100, 400))
+        x, y = rng.integers(0, bg.shape[1] - size), rng.integers(0, bg.shape[0] - size)
+        corner = bg[y:y + size, x:x + size]
+    elif kind == "blur":
+        corner = cv2.GaussianBlur(rng.integers(0, 255, (400, 400, 3), dtype=np.uint8), (0, 0), rng.uniform(1, 6))
+    elif kind == "shapes":
+        corner = np.full((400, 400, 3), int(rng.integers(30, 200)), dtype=np.uint8)
+        for _ in range(30):
+            color = tuple(int(v) for v in rng.integers(0, 255, 3))
+            p1, p2 = tuple(int(v) for v in rng.integers(0, 400, 2)), tuple(int(v) for v in rng.integers(0, 400, 2))
+            if rng.random() < 0.5:
+                cv2.rectangle(corner, p1, p2, color, -1)
+            else:
+                cv2.line(corner, p1, p2, color, int(rng.integers(1, 8)))
+    else:
+        raise ValueError(f"Unknown non-map frame kind: {kind}")
+    return _embed_full_map_corner(corner, capture_size)
+
+
+def synthesize_full_map_frame(seed: int = 0, capture_size: tuple[int, int] = (1000, 1000)) -> np.ndarray:
+    """
+    合成左下角是完整地图边框圆环的截图：地形背景局部上画一个半径约为区域0.425倍的圆环，圆心在中心附近随机偏移
+    """
+    rng = np.random.default_rng(seed)
+    bg = MAP_ASSETS.cv2_image(map_bg_path(int(rng.choice(MAP_BG_IDS))))
+    size = int(rng.integers(150, 500))
+    x, y = rng.integers(0, bg.shape[1] - size), rng.integers(0, bg.shape[0] - size)
+    corner = cv2.resize(bg[y:y + size, x:x + size], (400, 400), interpolation=cv2.INTER_AREA)
+    center = tuple(int(v) for v in 200 + rng.integers(-24, 24, 2))
+    color = tuple(int(v) for v in rng.integers(150, 255, 3))
+    cv2.circle(corner, center, int(170 + rng.integers(-4, 4)), color, int(rng.integers(3, 8)), cv2.LINE_AA)
+    return _embed_full_map_corner(corner, capture_size)
@@ -0,0 +1,281 @@
+import dataclasses
+import itertools
+import threading
+import unittest
+from unittest import mock
+
+import cv2
+import numpy as np
+
+from src.config import Config
+from src.detector.asset_cache import MAP_ASSET_CACHE
+from src.detector.map_assets import CV2_RESIZE_METHOD, MAP_ASSETS, MAP_BG_IDS, map_bg_path
+from src.detector.map_detector import (FullMapGateStats, MapDetectParam, MapDetector, POI_CONFIDENCE_TEMPERATURE,
+                                       PoiCompositeTensor,
+                                       PREDICT_EARTH_SHIFTING_OFFSET_AND_STRIDE, PREDICT_EARTH_SHIFTING_SCALES,
+                                       PREDICT_EARTH_SHIFTING_SIZE, PREDICT_EARTH_SHIFTING_SIZE_REGION,
+                                       pattern_confidence)
+from src.detector.map_info import STD_MAP_SIZE
+from tests.map_synth import synthesize_full_map_frame, synthesize_map, synthesize_non_map_frame
+
+
+def patch_config(**changes):
+    return mock.patch.object(Config, "get", return_value=dataclasses.replace(Config.get(), **changes))
+
+
+def reference_match_earth_shifting(img: np.ndarray) -> tuple[int, float]:
+    """
+    改用背景金字塔之前的地形识别：逐个尺度缩放背景，逐个偏移计算距离的中位数
+    """
+    img = cv2.resize(img, PREDICT_EARTH_SHIFTING_SIZE, interpolation=CV2_RESIZE_METHOD)
+    x, y, w, h = PREDICT_EARTH_SHIFTING_SIZE_REGION
+    img = img[y:y + h, x:x + w].astype(int)
+    best_map_id, best_score = None, float('inf')
+    offset, stride = PREDICT_EARTH_SHIFTING_OFFSET_AND_STRIDE
+    min_scale, max_scale, scale_num = PREDICT_EARTH_SHIFTING_SCALES
+    for map_id in MAP_BG_IDS:
+        map_img = MAP_ASSETS.cv2_image(map_bg_path(map_id))
+        score = float('inf')
+        for scale in np.linspace(min_scale, max_scale, scale_num, endpoint=True):
+            size = (int(PREDICT_EARTH_SHIFTING_SIZE[0] * scale), int(PREDICT_EARTH_SHIFTING_SIZE[1] * scale))
+            map_resized = cv2.resize(map_img, size, interpolation=CV2_RESIZE_METHOD).astype(int)
+            for dx in range(-offset, offset + 1, stride):
+                for dy in range(-offset, offset + 1, stride):
+                    diff = np.abs(img - map_resized[y + dy:y + h + dy, x + dx:x + w + dx])
+                    diff[diff > 100] = 0
+                    score = min(score, float(np.median(np.linalg.norm(diff, axis=2))))
+        if score < best_score:
+            best_map_id, best_score = map_id, score
+    return best_map_id, best_score
+
+
+class MapDetectorTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.detector = MapDetector()
+        # 等待后台构建的混淆模型，避免使用默认的混淆矩阵
+        for earth_shifting in (0, 1):
+            cls.detector._get_poi_log_confusion(earth_shifting)
+            if earth_shifting in cls.detector.poi_confusion_futures:
+                cls.detector.poi_confusion_futures[earth_shifting].result()
+
+    def get_pattern(self, earth_shifting: int, nightlord_index: int = 0, pattern_index: int = 3):
+        nightlord = self.detector.info.get_nightlords(earth_shifting)[nightlord_index]
+        return self.detector.info.get_patterns(earth_shifting, nightlord)[pattern_index]
+
+    def test_unregistered_shifted_map_matches_pattern(self):
+        # 对齐被拒绝或关闭时，整体平移5~6像素的截图仍能识别出正确的模式
+        configs = {
+            "rejected": dict(map_register_enabled=True, map_register_min_correlation=1.01),
+            "disabled": dict(map_register_enabled=False),
+        }
+        for name, changes in configs.items():
+            for earth_shifting in (0, 1):
+                pattern = self.get_pattern(earth_shifting)
+                for shift in ((5, 5), (6, -6)):
+                    with self.subTest(registration=name, earth_shifting=earth_shifting, shift=shift), patch_config(**changes):
+                        img = synthesize_map(self.detector, pattern, shift=shift)
+                        matched, _, _, transform = self.detector._match_map_pattern(img, earth_shifting)
+                        self.assertIsNone(transform)
+                        self.assertEqual(matched.id, pattern.id)
+
+    def test_register_map_recovers_known_transform(self):
+        # 已知平移和缩放的截图，对齐结果与之一致
+        cases = {
+            "shift": dict(shift=(12, -10), scale=1.0),
+            "zoom": dict(shift=(0, 0), scale=1.05),
+            "zoom_shift": dict(shift=(-25, -25), scale=1.05),
+        }
+        for name, kwargs in cases.items():
+            for earth_shifting in (0, 1):
+                with self.subTest(case=name, earth_shifting=earth_shifting), patch_config(map_register_enabled=True):
+                    img = cv2.resize(synthesize_map(self.detector, self.get_pattern(earth_shifting), **kwargs), STD_MAP_SIZE)
+                    transform = self.detector._register_map(img, earth_shifting)
+                    self.assertIsNotNone(transform)
+                    self.assertAlmostEqual(transform.scale, kwargs["scale"], delta=0.002)
+                    self.assertAlmostEqual(transform.dx, kwargs["shift"][0], delta=0.5)
+                    self.assertAlmostEqual(transform.dy, kwargs["shift"][1], delta=0.5)
+
+    def test_earth_shifting_pyramid_matches_reference(self):
+        # 背景金字塔与逐个尺度和偏移计算的结果相同：地形和分数都一致
+        for earth_shifting in MAP_BG_IDS:
+            for seed, shift in enumerate(((0, 0), (9, -7))):
+                with self.subTest(earth_shifting=earth_shifting, shift=shift):
+                    img = synthesize_map(self.detector, self.get_pattern(earth_shifting), shift=shift, noise=8, seed=seed)
+                    map_id, score = self.detector._match_earth_shifting(img)
+                    expected_map_id, expected_score = reference_match_earth_shifting(img)
+                    self.assertEqual(map_id, expected_map_id)
+                    self.assertAlmostEqual(score, expected_score, places=6)
+
+    def test_cached_poi_composites_match_fresh_build(self):
+        # 从磁盘缓存内存映射加载的合成图像张量与重新构建的相同，识别出的模式、得分和置信度也相同
+        for earth_shifting in (0, 1):
+            # 确保缓存条目存在后再从磁盘读取
+            self.detector._get_poi_composite_tensor(earth_shifting)
+            arrays = MAP_ASSET_CACHE.load(f"poi_composites_{earth_shifting}", params=self.detector._poi_composite_cache_params())
+            self.assertIsInstance(arrays["composites"], np.memmap)
+            cached = PoiCompositeTensor.from_arrays(arrays)
+            fresh = self.detector._build_poi_composite_tensor(earth_shifting)
+            self.assertEqual(cached.positions, fresh.positions)
+            self.assertEqual(cached.ctypes, fresh.ctypes)
+            np.testing.assert_array_equal(cached.composites, fresh.composites)
+            np.testing.assert_array_equal(cached.sqsums, fresh.sqsums)
+
+            results = {}
+            for name, tensor in (("cached", cached), ("fresh", fresh)):
+                with mock.patch.dict(self.detector.poi_composite_tensors, {earth_shifting: tensor}):
+                    results[name] = []
+                    patterns = self.detector.info.get_patterns(earth_shifting)
+                    for seed in range(10):
+                        pattern = patterns[seed * len(patterns) // 10]
+                        img = synthesize_map(self.detector, pattern, shift=(seed % 4 - 2, 2 - seed % 3), noise=8, seed=seed)
+                        _, _, ranked, _ = self.detector._match_map_pattern(img, earth_shifting)
+                        results[name].append([(m.pattern.id, m.score, m.error, m.confidence) for m in ranked[:5]])
+            self.assertEqual(results["cached"], results["fresh"])
+
+    def test_degraded_map_has_low_confidence(self):
+        # 清晰的截图置信度足够，大面积遮挡且噪声较大的截图置信度低于重新识别的阈值
+        threshold = Config.get().map_pattern_rematch_confidence
+        for earth_shifting in (0, 1):
+            pattern = self.get_pattern(earth_shifting)
+            for degraded in (False, True):
+                kwargs = dict(occluded=0.5, noise=30) if degraded else {}
+                img = synthesize_map(self.detector, pattern, **kwargs)
+                with self.subTest(earth_shifting=earth_shifting, degraded=degraded, evidence=True):
+                    evidence, _, _ = self.detector._match_pois_until_decided(img, earth_shifting)
+                    confidence = self.detector._rank_map_patterns_by_evidence(evidence)[0].confidence
+                    self.assertEqual(confidence < threshold, degraded)
+                with self.subTest(earth_shifting=earth_shifting, degraded=degraded, evidence=False):
+                    _, _, ranked, _ = self.detector._match_map_pattern(img, earth_shifting)
+                    self.assertEqual(ranked[0].confidence < threshold, degraded)
+
+    def test_confidence_temperature_and_null_hypothesis(self):
+        # 温度：对数似然差为 T * ln(9) 的两个候选，置信度为 0.9
+        loglik = np.array([POI_CONFIDENCE_TEMPERATURE * np.log(9), 0.0])
+        self.assertAlmostEqual(pattern_confidence(loglik, -np.inf)[0], 0.9)
+        # 无关假设：似然与最佳候选相同时分走一半的置信度
+        self.assertAlmostEqual(pattern_confidence(np.array([0.0, -1e3]), 0.0)[0], 0.5)
+
+    def test_degraded_frame_below_tempered_threshold(self):
+        # 不加温度和无关假设时，退化截图与清晰截图的后验概率都接近1；
+        # 加上后只有退化截图低于重新识别的阈值，且无关假设分走的概率更多
+        threshold = Config.get().map_pattern_rematch_confidence
+        for earth_shifting in (0, 1):
+            pattern = self.get_pattern(earth_shifting)
+            null_mass = {}
+            for degraded in (False, True):
+                kwargs = dict(occluded=0.5, noise=30) if degraded else {}
+                img = synthesize_map(self.detector, pattern, **kwargs)
+                evidence, _, _ = self.detector._match_pois_until_decided(img, earth_shifting)
+                with self.subTest(earth_shifting=earth_shifting, degraded=degraded):
+                    raw = pattern_confidence(evidence.pattern_loglik * POI_CONFIDENCE_TEMPERATURE, -np.inf)
+                    self.assertGreaterEqual(raw.max(), threshold)
+                    posterior = evidence.posterior()
+                    self.assertEqual(posterior.max() < threshold, degraded)
+                    null_mass[degraded] = 1 - posterior.sum()
+            self.assertGreater(null_mass[True], null_mass[False])
+
+    def test_rematch_bypasses_pattern_cache(self):
+        # 低置信度的结果被缓存后，感知哈希相近的截图命中缓存；重新识别时跳过缓存重新计算置信度
+        pattern = self.get_pattern(0)
+        degraded = synthesize_map(self.detector, pattern, occluded=0.5, noise=30)
+        rematch = synthesize_map(self.detector, pattern, occluded=0.5, noise=4)
+
+        def detect(img, bypass_pattern_cache=False):
+            return self.detector.detect(None, MapDetectParam(
+                map_region=(0, 0, *img.shape[1::-1]), img=img, earth_shifting=0, do_match_pattern=True,
+                accumulate_evidence=True, bypass_pattern_cache=bypass_pattern_cache,
+            ))
+
+        self.detector.pattern_cache.clear()
+        with patch_config(map_evidence_max_frames=1, map_pattern_cache_size=4), \
+                mock.patch.object(self.detector, "get_overlay_image", return_value=None):
+            first = detect(degraded)
+            self.assertLess(first.pattern_confidence, Config.get().map_pattern_rematch_confidence)
+            cached = detect(rematch)
+            self.assertTrue(cached.pattern_from_cache)
+            self.assertEqual(cached.pattern_confidence, first.pattern_confidence)
+            rematched = detect(rematch, bypass_pattern_cache=True)
+            self.assertFalse(rematched.pattern_from_cache)
+            self.assertNotEqual(rematched.pattern_confidence, first.pattern_confidence)
+            # 重新识别的结果取代缓存中的旧结果
+            self.assertEqual(detect(rematch).pattern_confidence, rematched.pattern_confidence)
+        self.detector.pattern_cache.clear()
+
+    def test_pattern_cache_matches_uncached_detection(self):
+        # 同一地图的另一张截图命中缓存，结果与不使用缓存时相同；不同的地图不会命中缓存
+        def detect(img, earth_shifting):
+            return self.detector.detect(None, MapDetectParam(
+                map_region=(0, 0, *img.shape[1::-1]), img=img, earth_shifting=earth_shifting, do_match_pattern=True,
+            ))
+
+        captures = []
+        for earth_shifting in (0, 1):
+            patterns = self.detector.info.get_patterns(earth_shifting)
+            for i in range(10):
+                pattern = patterns[i * len(patterns) // 10]
+                captures.append((earth_shifting, *(synthesize_map(self.detector, pattern, noise=8, seed=seed) for seed in (i, i + 100))))
+
+        self.detector.pattern_cache.clear()
+        with mock.patch.object(self.detector, "get_overlay_image", return_value=None):
+            with patch_config(map_pattern_cache_size=0):
+                uncached = [(detect(first, es), detect(second, es)) for es, first, second in captures]
+            with patch_config(map_pattern_cache_size=4):
+                for (es, first, second), (expected_first, expected_second) in zip(captures, uncached):
+                    with self.subTest(earth_shifting=es, pattern=expected_first.pattern.id):
+                        result = detect(first, es)
+                        self.assertFalse(result.pattern_from_cache)
+                        self.assertEqual(result.pattern.id, expected_first.pattern.id)
+                        self.assertEqual(result.pattern_score, expected_first.pattern_score)
+                        result = detect(second, es)
+                        self.assertTrue(result.pattern_from_cache)
+                        self.assertEqual(result.pattern.id, expected_second.pattern.id)
+                        self.assertEqual(result.pattern_score, expected_first.pattern_score)
+        self.detector.pattern_cache.clear()
+
+    def test_poi_match_executor_survives_worker_change(self):
+        # 多个线程同时识别时修改线程数，正在使用的线程池不会被关闭
+        pattern = self.get_pattern(0)
+        img = cv2.resize(synthesize_map(self.detector, pattern), STD_MAP_SIZE)
+        base = Config.get()
+        configs = itertools.cycle([dataclasses.replace(base, map_poi_match_workers=w) for w in (2, 3, 4)])
+        errors = []
+
+        def run():
+            try:
+                for _ in range(20):
+                    self.detector._score_pois(img, 0)
+            except Exception as e:
+                errors.append(e)
+
+        with mock.patch.object(Config, "get", side_effect=lambda: next(configs)):
+            threads = [threading.Thread(target=run) for _ in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(self.detector.poi_match_executor_users, 0)
+        self.assertEqual(self.detector.retired_poi_match_executors, [])
+
+    def test_full_map_gate_rejects_non_map_frames(self):
+        # 边缘点数足够的普通画面大部分在霍夫圆检测前被圆环检查排除，有地图边框圆环的画面不被排除
+        threshold = Config.get().full_map_error_threshold
+        for kind in ("terrain", "blur", "shapes"):
+            self.detector.full_map_gate_stats = FullMapGateStats()
+            for seed in range(40):
+                with self.subTest(kind=kind, seed=seed):
+                    self.assertGreater(self.detector._match_full_map(synthesize_non_map_frame(kind, seed)), threshold)
+            stats = self.detector.full_map_gate_stats
+            with self.subTest(kind=kind):
+                self.assertGreaterEqual(stats.rejected_by_ring + stats.rejected_by_edges + stats.rejected_by_contrast,
+                                        0.9 * stats.checked)
+        self.detector.full_map_gate_stats = FullMapGateStats()
+        matched = sum(self.detector._match_full_map(synthesize_full_map_frame(seed)) <= threshold for seed in range(40))
+        stats = self.detector.full_map_gate_stats
+        self.assertEqual(stats.rejected_by_ring + stats.rejected_by_edges + stats.rejected_by_contrast, 0)
+        self.assertGreaterEqual(matched, 36)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+import csv
+import unittest
+from dataclasses import dataclass, fields
+
+from src.common import get_data_path
+from src.detector.asset_cache import MAP_INFO_CACHE
+from src.detector.map_info import Construct, MapInfo, POI_CONSTRUCTS, Position, load_map_info
+
+CSV_PATHS = (
+    get_data_path('csv/map_patterns.csv'),
+    get_data_path('csv/constructs.csv'),
+    get_data_path('csv/names.csv'),
+    get_data_path('csv/positions.csv'),
+)
+
+
+@dataclass
+class ReferenceMapPattern:
+    """
+    改为列式存储之前的地图模式数据类，用于核对模式视图的每个字段
+    """
+    id: int
+    nightlord: int
+    earth_shifting: int
+    start_pos: Position
+    day1_boss: int
+    day1_extra_boss: int
+    day1_pos: Position
+    day2_boss: int
+    day2_extra_boss: int
+    day2_pos: Position
+    treasure: int
+    rot_rew: int
+    event_value: int
+    event_flag: int
+    evpat_value: int
+    evpat_flag: int
+    pos_constructions: dict[Position, Construct]
+
+
+def load_reference_patterns() -> tuple[list[ReferenceMapPattern], set[Position], set[int]]:
+    """
+    改为列式存储之前的读取方式：逐行创建数据类
+    """
+    map_patterns_csv_path, constructs_csv_path, _, positions_csv_path = CSV_PATHS
+    with open(positions_csv_path, 'r', encoding='utf-8') as f:
+        f.readline()
+        pos_dict = {}
+        for row in csv.reader(f):
+            x, y = float(row[7]), float(row[8])
+            x = int((x - 907.5537109) / 6.045 + 127.26920918617023)
+            y = int((y - 1571.031006) / 6.045 + 242.71771372340424)
+            pos_dict[int(row[0])] = (x, y)
+
+    with open(constructs_csv_path, 'r', encoding='utf-8') as f:
+        f.readline()
+        map_construct_dict: dict[int, list[Construct]] = {}
+        all_poi_pos, all_poi_construct_type = set(), set()
+        for row in csv.reader(f):
+            construct = Construct(type=int(row[2]), pos=pos_dict[int(row[4])], is_display=(row[3] == '1'))
+            map_construct_dict.setdefault(int(row[1]), []).append(construct)
+            if construct.type // 1000 in POI_CONSTRUCTS:
+                all_poi_pos.add(construct.pos)
+                all_poi_construct_type.add(construct.type)
+        all_poi_construct_type.add(0)
+
+    with open(map_patterns_csv_path, 'r', encoding='utf-8') as f:
+        f.readline()
+        patterns = []
+        for row in csv.reader(f):
+            patterns.append(ReferenceMapPattern(
+                id=int(row[0]),
+                nightlord=int(row[1]),
+                earth_shifting=int(row[2]),
+                start_pos=pos_dict[int(row[3])],
+                treasure=int(row[4]),
+                event_value=int(row[5]),
+                event_flag=int(row[6]),
+                evpat_value=int(row[7]),
+                evpat_flag=int(row[8]),
+                rot_rew=int(row[9]),
+                day1_boss=int(row[10]),
+                day1_pos=pos_dict[int(row[11])],
+                day2_boss=int(row[12]),
+                day2_pos=pos_dict[int(row[13])],
+                day1_extra_boss=int(row[14]),
+                day2_extra_boss=int(row[15]),
+                pos_constructions={c.pos: c for c in map_construct_dict.get(int(row[0]), [])},
+            ))
+    return patterns, all_poi_pos, all_poi_construct_type
+
+
+class MapInfoTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.reference, cls.all_poi_pos, cls.all_poi_construct_type = load_reference_patterns()
+
+    def assert_matches_reference(self, info: MapInfo):
+        self.assertEqual(len(info.patterns), len(self.reference))
+        for pattern, expected in zip(info.patterns, self.reference):
+            for f in fields(ReferenceMapPattern):
+                with self.subTest(id=expected.id, field=f.name):
+                    self.assertEqual(getattr(pattern, f.name), getattr(expected, f.name))
+        self.assertEqual(info.all_poi_pos, self.all_poi_pos)
+        self.assertEqual(info.all_poi_construct_type, self.all_poi_construct_type)
+        # 索引按ID排序
+        by_earth_shifting = {}
+        for expected in sorted(self.reference, key=lambda p: p.id):
+            by_earth_shifting.setdefault(expected.earth_shifting, []).append(expected.id)
+        for earth_shifting, ids in by_earth_shifting.items():
+            self.assertEqual([p.id for p in info.get_patterns(earth_shifting)], ids)
+
+    def test_csv_table_matches_reference(self):
+        self.assert_matches_reference(load_map_info(*CSV_PATHS))
+
+    def test_cached_table_matches_reference(self):
+        self.assert_matches_reference(MapInfo.from_arrays(load_map_info(*CSV_PATHS).to_arrays()))
+        self.assert_matches_reference(load_map_info(*CSV_PATHS, cache=MAP_INFO_CACHE))
+
+    def test_pattern_views_compare_by_value(self):
+        patterns = load_map_info(*CSV_PATHS).patterns
+        cached = load_map_info(*CSV_PATHS, cache=MAP_INFO_CACHE).patterns
+        self.assertEqual(patterns, cached)
+        self.assertEqual({hash(p) for p in patterns}, {hash(p) for p in cached})
+        self.assertEqual(len(set(patterns) | set(cached)), len(patterns))
+        self.assertNotEqual(patterns[0], patterns[1])
+        self.assertNotEqual(patterns[0], self.reference[0])
+
+
+if __name__ == "__main__":
+    unittest.main()